@@ -0,0 +1,247 @@
+"""Throughput benchmarks for Seq2SeqModel on synthetic corpora.
+
+Each variant in the variants file overrides the base "model", "train" and
+"corpus" sections. Every variant runs in a fresh process so that graph build
+time and peak RSS are not polluted by earlier variants. Results are written as
+JSON and can be compared against a stored baseline:
+
+    python -m benchmarks.run --bench_output results.json
+    python -m benchmarks.run --bench_output new.json --bench_baseline results.json
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import vrae
+from benchmarks import synthetic
+
+tf.app.flags.DEFINE_string("bench_variants", os.path.join(os.path.dirname(__file__), "variants.json"),
+                           "json file with the base config and the variants to benchmark.")
+tf.app.flags.DEFINE_string("bench_only", "", "comma separated variant names to run (default: all).")
+tf.app.flags.DEFINE_string("bench_output", "benchmark_results.json", "where to write the results.")
+tf.app.flags.DEFINE_string("bench_baseline", None, "results file to compare against.")
+tf.app.flags.DEFINE_float("bench_tolerance", 0.05, "relative slowdown reported as a regression.")
+tf.app.flags.DEFINE_integer("bench_warmup_steps", 3, "untimed steps before each measurement.")
+tf.app.flags.DEFINE_integer("bench_steps", 20, "timed steps per measurement.")
+tf.app.flags.DEFINE_integer("bench_threads", 0,
+                            "intra/inter op thread cap (0: the variant's own session config).")
+
+FLAGS = tf.app.flags.FLAGS
+
+# metric name -> True if higher is better.
+METRICS = {
+    "train_tokens_per_s": True,
+    "encode_tokens_per_s": True,
+    "decode_tokens_per_s": True,
+    "train_graph_build_s": False,
+    "inference_graph_build_s": False,
+    "peak_rss_mb": False,
+}
+
+
+def _merge(base, overrides):
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def _session_config(config, num_threads):
+    if not num_threads:
+        return vrae.session_config(config)
+    return tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                          inter_op_parallelism_threads=num_threads)
+
+
+def _timed(fn, warmup_steps, steps):
+    """Runs fn warmup_steps + steps times; returns (tokens, seconds) of the timed part."""
+    for _ in range(warmup_steps):
+        fn()
+    tokens, start = 0, time.time()
+    for _ in range(steps):
+        tokens += fn()
+    return tokens, time.time() - start
+
+
+def bench_train(config, data_set, warmup_steps, steps, num_threads):
+    bucket_sizes = [len(data_set[b]) for b in range(len(config.buckets))]
+    total_size = float(sum(bucket_sizes))
+    buckets_scale = [sum(bucket_sizes[:i + 1]) / total_size for i in range(len(bucket_sizes))]
+
+    with tf.Graph().as_default(), tf.Session(config=_session_config(config, num_threads)) as sess:
+        start = time.time()
+        model = vrae.build_model(config, False)
+        sess.run(tf.global_variables_initializer())
+        build_time = time.time() - start
+
+        def train_step():
+            random_number_01 = np.random.random_sample()
+            bucket_id = min([i for i in range(len(buckets_scale)) if buckets_scale[i] > random_number_01])
+            encoder_inputs, decoder_inputs, target_weights = model.get_batch(data_set, bucket_id)
+            model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id, False,
+                       config.probabilistic)
+            return int(sum(np.sum(w) for w in target_weights))
+
+        tokens, seconds = _timed(train_step, warmup_steps, steps)
+    return build_time, tokens / seconds
+
+
+def bench_inference(config, data_set, warmup_steps, steps, num_threads):
+    non_empty = [b for b in range(len(config.buckets)) if data_set[b]]
+
+    with tf.Graph().as_default(), tf.Session(config=_session_config(config, num_threads)) as sess:
+        start = time.time()
+        model = vrae.build_model(config, True)
+        sess.run(tf.global_variables_initializer())
+        build_time = time.time() - start
+
+        def encode_step():
+            bucket_id = non_empty[np.random.randint(len(non_empty))]
+            encoder_inputs, _, _ = model.get_batch(data_set, bucket_id)
+            model.encode_to_latent(sess, encoder_inputs, bucket_id)
+            return int(sum(np.count_nonzero(inp) for inp in encoder_inputs))
+
+        encode_tokens, encode_seconds = _timed(encode_step, warmup_steps, steps)
+
+        bucket_id = len(config.buckets) - 1
+        _, decoder_inputs, target_weights = model.get_batch({bucket_id: [([], [])]}, bucket_id)
+        logvars = np.full((model.batch_size, config.latent_dim), -800.0, dtype=np.float32)
+
+        def decode_step():
+            means = np.random.normal(size=(model.batch_size, config.latent_dim)).astype(np.float32)
+            outputs = model.decode_from_latent(sess, means, logvars, bucket_id, decoder_inputs, target_weights)
+            return len(outputs) * model.batch_size
+
+        decode_tokens, decode_seconds = _timed(decode_step, warmup_steps, steps)
+    return build_time, encode_tokens / encode_seconds, decode_tokens / decode_seconds
+
+
+def run_variant(variant, warmup_steps, steps, num_threads):
+    """Benchmark one fully merged variant; meant to run in its own process."""
+    config = vrae.Struct(**variant["model"])
+    config.update(**variant["train"])
+    corpus = variant["corpus"]
+
+    work_dir = tempfile.mkdtemp(prefix="vrae_bench_")
+    try:
+        corpus_path = os.path.join(work_dir, "train.ids")
+        synthetic.write_corpus(corpus_path, corpus["num_sentences"], config.vocab_size,
+                               corpus["length_dist"], corpus.get("zipf_exponent", 1.1),
+                               corpus.get("seed", 0))
+        data_set = vrae.read_data(corpus_path, config)
+    finally:
+        shutil.rmtree(work_dir)
+    np.random.seed(corpus.get("seed", 0))
+
+    train_build, train_tps = bench_train(config, data_set, warmup_steps, steps, num_threads)
+    inference_build, encode_tps, decode_tps = bench_inference(config, data_set, warmup_steps, steps,
+                                                              num_threads)
+    return {
+        "name": variant["name"],
+        "config": variant,
+        "train_graph_build_s": train_build,
+        "inference_graph_build_s": inference_build,
+        "train_tokens_per_s": train_tps,
+        "encode_tokens_per_s": encode_tps,
+        "decode_tokens_per_s": decode_tps,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _run_variant_in_child(queue, variant, warmup_steps, steps, num_threads):
+    queue.put(run_variant(variant, warmup_steps, steps, num_threads))
+
+
+def compare(results, baseline, tolerance):
+    """Print per-metric changes against baseline; return the number of regressions."""
+    baseline_by_name = dict((r["name"], r) for r in baseline["results"])
+    regressions = 0
+    for result in results:
+        base = baseline_by_name.get(result["name"])
+        if base is None:
+            print("%s: not in baseline" % result["name"])
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("%-24s %-26s %12.2f -> %12.2f (%+.1f%%)%s" % (
+                result["name"], metric, old, new, 100.0 * change, flag))
+    return regressions
+
+
+def main(_):
+    with open(FLAGS.bench_variants) as f:
+        spec = json.load(f)
+    only = set(name for name in FLAGS.bench_only.split(",") if name)
+    variants = [_merge(spec["base"], v) for v in spec["variants"] if not only or v["name"] in only]
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for variant in variants:
+        print("Benchmarking %s" % variant["name"])
+        sys.stdout.flush()
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_variant_in_child,
+                           args=(queue, variant, FLAGS.bench_warmup_steps, FLAGS.bench_steps,
+                                 FLAGS.bench_threads))
+        proc.start()
+        proc.join()
+        if proc.exitcode != 0:
+            raise RuntimeError("benchmark variant %s failed with exit code %s" % (variant["name"], proc.exitcode))
+        result = queue.get()
+        print("  train %.0f tok/s, encode %.0f tok/s, decode %.0f tok/s, "
+              "build %.1fs/%.1fs, peak rss %.0f MB" % (
+                  result["train_tokens_per_s"], result["encode_tokens_per_s"],
+                  result["decode_tokens_per_s"], result["train_graph_build_s"],
+                  result["inference_graph_build_s"], result["peak_rss_mb"]))
+        results.append(result)
+
+    with open(FLAGS.bench_output, "w") as f:
+        json.dump({"created": time.time(),
+                   "host": platform.node(),
+                   "tensorflow": tf.__version__,
+                   "steps": FLAGS.bench_steps,
+                   "threads": FLAGS.bench_threads,
+                   "results": results}, f, indent=2)
+    print("Wrote %s" % FLAGS.bench_output)
+
+    if FLAGS.bench_baseline:
+        with open(FLAGS.bench_baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, FLAGS.bench_tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,57 @@
+"""Synthetic token-id corpora with controlled length distributions.
+
+Token ids are drawn from a Zipf distribution over the non-special part of the
+vocabulary, so embedding lookups and the output projection see a realistic
+skew. Files are written in the same one-sentence-per-line `.ids` format that
+`data_utils.data_to_token_ids` produces, so `vrae.read_data` can load them.
+"""
+
+import numpy as np
+
+import utils.data_utils as data_utils
+
+
+def sample_lengths(rng, num_sentences, length_dist):
+    """Draw sentence lengths.
+
+    Args:
+      rng: a numpy RandomState.
+      num_sentences: number of lengths to draw.
+      length_dist: dict with a "type" key, one of
+        - "fixed": {"length"}
+        - "uniform": {"min", "max"} (inclusive)
+        - "normal": {"mean", "std", "min", "max"} (clipped)
+
+    Returns:
+      int array of shape [num_sentences].
+    """
+    kind = length_dist.get("type", "uniform")
+    if kind == "fixed":
+        return np.full(num_sentences, length_dist["length"], dtype=np.int64)
+    if kind == "uniform":
+        return rng.randint(length_dist["min"], length_dist["max"] + 1, size=num_sentences)
+    if kind == "normal":
+        lengths = np.rint(rng.normal(length_dist["mean"], length_dist["std"], size=num_sentences))
+        return np.clip(lengths, length_dist.get("min", 1), length_dist["max"]).astype(np.int64)
+    raise ValueError("unknown length distribution type: %s" % kind)
+
+
+def zipf_token_ids(rng, vocab_size, num_tokens, exponent=1.1):
+    """Draw num_tokens ids in [len(_START_VOCAB), vocab_size) with Zipfian frequencies."""
+    first_id = len(data_utils._START_VOCAB)
+    ranks = np.arange(1, vocab_size - first_id + 1, dtype=np.float64)
+    probs = ranks ** -exponent
+    probs /= probs.sum()
+    return rng.choice(vocab_size - first_id, size=num_tokens, p=probs) + first_id
+
+
+def write_corpus(path, num_sentences, vocab_size, length_dist, zipf_exponent=1.1, seed=0):
+    """Write a synthetic token-id corpus to path and return its total token count."""
+    rng = np.random.RandomState(seed)
+    lengths = sample_lengths(rng, num_sentences, length_dist)
+    ids = zipf_token_ids(rng, vocab_size, int(lengths.sum()), zipf_exponent)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    with open(path, "w") as f:
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            f.write(" ".join(str(tok) for tok in ids[start:end]) + "\n")
+    return int(lengths.sum())
@@ -0,0 +1,77 @@
+"""Run a distributed vrae.py training cluster as processes on localhost.
+
+Every parameter server and worker is a separate `vrae.py` process with its own
+free localhost port. Arguments after `--` are passed to every process, e.g.
+
+    python local_cluster.py --num_ps 1 --num_workers 2 -- --model_dir models --do train --new True
+
+Each process logs to `<log_dir>/<job>_<task>.log`. The cluster is torn down
+when the chief exits or on Ctrl-C.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def free_ports(n):
+    """Reserve n distinct free TCP ports on localhost."""
+    sockets, ports = [], []
+    for _ in range(n):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+        ports.append(sock.getsockname()[1])
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num_ps", type=int, default=1)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--log_dir", default="cluster_logs")
+    parser.add_argument("vrae_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    vrae_args = args.vrae_args[1:] if args.vrae_args[:1] == ["--"] else args.vrae_args
+
+    ports = free_ports(args.num_ps + args.num_workers)
+    ps_hosts = ",".join("localhost:%d" % p for p in ports[:args.num_ps])
+    worker_hosts = ",".join("localhost:%d" % p for p in ports[args.num_ps:])
+    if not os.path.exists(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    vrae = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vrae.py")
+    procs = {}
+    for job, count in (("ps", args.num_ps), ("worker", args.num_workers)):
+        for task in range(count):
+            log = open(os.path.join(args.log_dir, "%s_%d.log" % (job, task)), "w")
+            cmd = [sys.executable, vrae] + vrae_args + [
+                "--job_name", job, "--task_index", str(task),
+                "--ps_hosts", ps_hosts, "--worker_hosts", worker_hosts]
+            procs[(job, task)] = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+            print("started %s %d (pid %d), logging to %s" % (job, task, procs[(job, task)].pid, log.name))
+
+    chief = procs[("worker", 0)]
+    try:
+        while chief.poll() is None:
+            for (job, task), proc in procs.items():
+                if proc.poll() not in (None, 0):
+                    raise RuntimeError("%s %d exited with code %d" % (job, task, proc.returncode))
+            time.sleep(1)
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs.values():
+            proc.wait()
+    return chief.returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -61,6 +61,7 @@ from tensorflow.contrib import rnn
 from tensorflow.python.framework import ops
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import embedding_ops
+from tensorflow.python.ops import gen_math_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
@@ -83,8 +84,36 @@ def prelu(_x):
         return pos + neg
 
 
+def quantized_xw_plus_b(x, w_q, w_scales, b):
+    """Computes x * W^T + b from int8 row-quantized weights.
+
+    The activations are quantized per tensor to quint8 on the fly and multiplied
+    with the quantized weights by an 8-bit matmul with int32 accumulation; the
+    per-row scales are applied to the dequantized accumulators.
+
+    Args:
+      x: 2D float Tensor [batch_size x input_size].
+      w_q: 2D uint8 Tensor [num_rows x input_size] as made by
+        utils.quantization.quantize_rows (values offset by 128).
+      w_scales: 1D float Tensor [num_rows] of per-row scales.
+      b: 1D float Tensor [num_rows] of biases.
+
+    Returns:
+      2D float Tensor [batch_size x num_rows].
+    """
+    # quantize_v2 needs a non-empty range that contains zero.
+    x_min = math_ops.minimum(math_ops.reduce_min(x), 0.0)
+    x_max = math_ops.maximum(math_ops.reduce_max(x), x_min + 1e-6)
+    x_q, x_q_min, x_q_max = tf.quantize_v2(x, x_min, x_max, tf.quint8)
+    acc, acc_min, acc_max = gen_math_ops.quantized_mat_mul(
+        x_q, tf.bitcast(w_q, tf.quint8), x_q_min, x_q_max, -128.0, 127.0,
+        Toutput=tf.qint32, transpose_b=True)
+    return tf.dequantize(acc, acc_min, acc_max) * w_scales + b
+
+
 def _extract_argmax_and_embed(embedding, output_projection=None,
-                              update_embedding=True):
+                              update_embedding=True, projection_function=None,
+                              symbol_map=None):
     """Get a loop_function that extracts the previous symbol and embeds it.
 
     Args:
@@ -93,16 +122,24 @@ def _extract_argmax_and_embed(embedding, output_projection=None,
         output will first be multiplied by W and added B.
       update_embedding: Boolean; if False, the gradients will not propagate
         through the embeddings.
+      projection_function: None or a function mapping outputs to logits; used
+        instead of output_projection if provided.
+      symbol_map: None or a 1D int Tensor; if provided, the argmax is an index
+        into symbol_map, which holds the actual symbol ids (e.g. a shortlist).
 
     Returns:
       A loop function.
     """
 
     def loop_function(prev, _):
-        if output_projection is not None:
+        if projection_function is not None:
+            prev = projection_function(prev)
+        elif output_projection is not None:
             prev = nn_ops.xw_plus_b(
                 prev, output_projection[0], output_projection[1])
         prev_symbol = math_ops.argmax(prev, 1)
+        if symbol_map is not None:
+            prev_symbol = array_ops.gather(symbol_map, prev_symbol)
         # Note that gradients will not propagate through the second parameter of
         # embedding_lookup.
         emb_prev = embedding_ops.embedding_lookup(embedding, prev_symbol)
@@ -129,6 +166,10 @@ def rnn_decoder(decoder_inputs, initial_state, cell, word_dropout_keep_prob=1, r
           * prev is a 2D Tensor of shape [batch_size x output_size],
           * i is an integer, the step number (when advanced control is needed),
           * next is a 2D Tensor of shape [batch_size x input_size].
+      word_dropout_keep_prob: probability of feeding loop_function's output as
+        the next input; otherwise that sentence gets replace_inp at that step.
+      replace_inp: 2D Tensor [batch_size x input_size], the input fed in place
+        of dropped words.
       scope: VariableScope for the created subgraph; defaults to "rnn_decoder".
 
     Returns:
@@ -144,14 +185,18 @@ def rnn_decoder(decoder_inputs, initial_state, cell, word_dropout_keep_prob=1, r
         state = initial_state
         outputs = []
         prev = None
-        seq_len = len(decoder_inputs)
-        keep = tf.where(tf.random_uniform([seq_len]) < word_dropout_keep_prob,
-                        tf.fill([seq_len], True), tf.fill([seq_len], False))
+        if 0 < word_dropout_keep_prob < 1:
+            # One keep flag per sentence and step, drawn for all steps at once.
+            batch_size = tf.shape(decoder_inputs[0])[0]
+            keep = tf.random_uniform([batch_size, len(decoder_inputs)]) < word_dropout_keep_prob
         for i, inp in enumerate(decoder_inputs):
             if loop_function is not None and prev is not None:
                 with variable_scope.variable_scope("loop_function", reuse=True):
-                    if word_dropout_keep_prob < 1:
-                        inp = tf.cond(keep[i], lambda: loop_function(prev, i), lambda: replace_inp)
+                    if word_dropout_keep_prob <= 0:
+                        # Every word is dropped; don't project onto the vocabulary for nothing.
+                        inp = replace_inp
+                    elif word_dropout_keep_prob < 1:
+                        inp = tf.where(keep[:, i], loop_function(prev, i), replace_inp)
                     else:
                         inp = loop_function(prev, i)
             if i > 0:
@@ -235,6 +280,8 @@ def embedding_rnn_decoder(decoder_inputs,
                           update_embedding_for_previous=True,
                           weight_initializer=None,
                           beam_size=1,
+                          projection_function=None,
+                          symbol_map=None,
                           scope=None):
     """RNN decoder with embedding and a pure-decoding option.
 
@@ -259,6 +306,11 @@ def embedding_rnn_decoder(decoder_inputs,
         symbol) will be updated by back propagation. Embeddings for the symbols
         generated from the decoder itself remain unchanged. This parameter has
         no effect if feed_previous=False.
+      projection_function: None or a function mapping outputs to logits, used
+        instead of output_projection when feeding previous outputs (e.g.
+        quantized_xw_plus_b).
+      symbol_map: None or a 1D int Tensor mapping the argmax of
+        projection_function's logits to symbol ids.
       scope: VariableScope for the created subgraph; defaults to
         "embedding_rnn_decoder".
 
@@ -295,7 +347,8 @@ def embedding_rnn_decoder(decoder_inputs,
         else:
             loop_function = _extract_argmax_and_embed(
                 embedding, output_projection,
-                update_embedding_for_previous) if feed_previous else None
+                update_embedding_for_previous, projection_function,
+                symbol_map) if feed_previous else None
 
         emb_inp = [
             embedding_ops.embedding_lookup(embedding, i) for i in decoder_inputs]
@@ -676,6 +729,45 @@ def sample(means,
     return latent_vector, kl_obj, kl_cost  # both kl_obj and kl_cost are scalar
 
 
+def sample_log_weights(means,
+                       logvars,
+                       latent_dim,
+                       iaf=True,
+                       dtype=None):
+    """Sample latent vectors with the per-example log density ratio for importance weighting.
+
+    Uses the same transformation (and "iaf" variables) as sample, so it must
+    be called under a reusing variable scope once sample has been built.
+
+    Args:
+      means: tensor of shape (batch_size, latent_dim)
+      logvars: tensor of shape (batch_size, latent_dim)
+      latent_dim: dimension of latent space.
+      iaf: perform linear IAF or not.
+    Returns:
+      latent_vector: latent variable after sampling. A vector of shape (batch_size, latent_dim).
+      log_ratio: log q(z|x) - log p(z) of every sample, a vector of shape (batch_size,).
+    """
+    prior = DiagonalGaussian(tf.zeros_like(means, dtype=dtype),
+                             tf.zeros_like(logvars, dtype=dtype))
+    posterior = DiagonalGaussian(means, logvars)
+    z = posterior.sample
+    logqs = posterior.logps(z)
+    if iaf:
+        with tf.variable_scope('iaf'):
+            # The unit lower-triangular transformation preserves volume, so
+            # log q of the transformed sample equals logqs.
+            L = tf.get_variable("inverse_cholesky", [latent_dim, latent_dim], dtype=dtype,
+                                initializer=tf.zeros_initializer())
+            L = tf.matrix_set_diag(L, tf.ones([latent_dim], dtype=dtype))
+            L = L * np.tril(np.ones([latent_dim, latent_dim]))
+            latent_vector = tf.matmul(z, L)
+    else:
+        latent_vector = z
+    logps = prior.logps(latent_vector)
+    return latent_vector, tf.reduce_sum(logqs - logps, [1])
+
+
 def encoder_to_latent(encoder_state,
                       embedding_size,
                       latent_dim,
@@ -16,12 +16,17 @@
 """Sequence-to-sequence model with an attention mechanism."""
 
 import random
+import time
 
 import numpy as np
 import tensorflow as tf
 
 import seq2seq_helper
 import utils.data_utils as data_utils
+from utils.adaptive_softmax import AdaptiveSoftmax
+from utils.distributions import compute_lowerbound, repeat
+from utils.profiler import StepProfiler
+from utils.quantization import quantize_rows
 
 
 class Seq2SeqModel(object):
@@ -63,6 +68,16 @@ class Seq2SeqModel(object):
                  weight_initializer=None,
                  bias_initializer=None,
                  iaf=False,
+                 num_towers=1,
+                 quantize_projection=False,
+                 shortlist_size=0,
+                 unigram_counts=None,
+                 unigram_distortion=0.75,
+                 adaptive_cutoffs=None,
+                 adaptive_factor=4,
+                 share_embeddings=False,
+                 train_embeddings=False,
+                 iw_samples=0,
                  dtype=tf.float32):
         """Create the model.
 
@@ -83,9 +98,49 @@ class Seq2SeqModel(object):
           learning_rate: learning rate to start with.
           use_lstm: if true, we use LSTM cells instead of GRU cells.
           num_samples: number of samples for sampled softmax.
+          unigram_counts: None or a list of target_vocab_size token counts; if
+            provided, sampled softmax draws its candidates from this unigram
+            distribution instead of the default log-uniform (Zipfian) one.
+          unigram_distortion: the counts are raised to this power before use.
           forward_only: if set, we do not construct the backward pass in the model.
+          num_towers: number of data-parallel replicas of the model that share
+            variables; each batch is split evenly across them, so batch_size
+            must be divisible by num_towers.
+          quantize_projection: if set (and forward_only), decode with an int8
+            copy of the output projection; call quantize(session) after the
+            float parameters are loaded.
+          shortlist_size: if positive (and forward_only), decode over the
+            shortlist_size most frequent target ids plus the ids of the batch's
+            inputs only; output logits are then indexed by position in
+            self.shortlist, see output_ids.
+          adaptive_cutoffs: None or increasing target ids splitting the
+            frequency-sorted vocabulary into a head and tail clusters; if
+            provided, an adaptive softmax replaces sampled softmax in training
+            and the full output projection in decoding.
+          adaptive_factor: each tail cluster projects to a factor times
+            smaller dimension than the previous one.
+          share_embeddings: if set, the encoder and the decoder look up one
+            "embedding" variable instead of separate "enc_embedding" and
+            "dec_embedding" ones; requires equal vocabulary sizes. restore()
+            loads checkpoints saved with either setting.
+          train_embeddings: if set, the embeddings are trained along with the
+            rest of the model instead of staying fixed at the loaded matrix.
+          iw_samples: if positive, also build importance-weighted bounds on
+            -log p(x) with this many latent samples per example, see
+            importance_weighted_step.
           dtype: the data type to use to store internal variables.
         """
+        if batch_size % num_towers != 0:
+            raise ValueError("batch_size must be divisible by num_towers,"
+                             " %d %% %d != 0." % (batch_size, num_towers))
+        if share_embeddings and source_vocab_size != target_vocab_size:
+            raise ValueError("share_embeddings requires equal vocabulary sizes,"
+                             " got %d and %d." % (source_vocab_size, target_vocab_size))
+        if iw_samples > 0 and shortlist_size > 0:
+            raise ValueError("iw_samples needs the full vocabulary, it cannot be used with shortlist_size.")
+        if adaptive_cutoffs and (quantize_projection or shortlist_size > 0):
+            raise ValueError("quantize_projection and shortlist_size need the full"
+                             " output projection, which adaptive softmax replaces.")
         self.source_vocab_size = source_vocab_size
         self.target_vocab_size = target_vocab_size
         self.latent_dim = latent_dim
@@ -93,13 +148,40 @@ class Seq2SeqModel(object):
         self.batch_size = batch_size
         self.word_dropout_keep_prob = word_dropout_keep_prob
         self.kl_min = kl_min
+        self.num_towers = num_towers
+        self.optimizer = optimizer
+        self.shortlist_size = shortlist_size if forward_only else 0
+        self.shortlist_ids = None
+        # Disabled by default; vrae.py swaps in an enabled one under --profile.
+        self.profiler = StepProfiler()
+        # Optional LRU cache of encode/reconstruct results, set by vrae.py, and
+        # the id of the checkpoint the parameters were restored from.
+        self.cache = None
+        self.checkpoint_id = None
+        # (phase, seconds, graph nodes added) for each phase of graph construction.
+        self.build_phases = []
+        self._build_mark = (time.time(), len(tf.get_default_graph().get_operations()))
         feed_previous = feed_previous or forward_only
 
         self.learning_rate = tf.Variable(
             float(learning_rate), trainable=False, dtype=dtype)
 
-        self.enc_embedding = tf.get_variable("enc_embedding", [source_vocab_size, size], dtype=dtype, trainable=False)
-        self.dec_embedding = tf.get_variable("dec_embedding", [target_vocab_size, size], dtype=dtype, trainable=False)
+        self.share_embeddings = share_embeddings
+        if share_embeddings:
+            self.enc_embedding = tf.get_variable("embedding", [source_vocab_size, size], dtype=dtype,
+                                                 trainable=train_embeddings)
+            self.dec_embedding = self.enc_embedding
+        else:
+            self.enc_embedding = tf.get_variable("enc_embedding", [source_vocab_size, size], dtype=dtype,
+                                                 trainable=train_embeddings)
+            self.dec_embedding = tf.get_variable("dec_embedding", [target_vocab_size, size], dtype=dtype,
+                                                 trainable=train_embeddings)
+        # Pretrained embeddings are fed through a placeholder so the matrix is
+        # never serialized into the GraphDef as a constant.
+        self.embedding_input = tf.placeholder(dtype, shape=[target_vocab_size, size], name="embedding_input")
+        self.embedding_init_ops = [tf.assign(self.enc_embedding, self.embedding_input)]
+        if not share_embeddings:
+            self.embedding_init_ops.append(tf.assign(self.dec_embedding, self.embedding_input))
 
         self.kl_rate = tf.Variable(
             0.0, trainable=False, dtype=dtype)
@@ -113,14 +195,58 @@ class Seq2SeqModel(object):
 
         # If we use sampled softmax, we need an output projection.
         output_projection = None
+        projection_function = None
+        symbol_map = None
         softmax_loss_function = None
+        quantized_variables = []
+        if adaptive_cutoffs:
+            adaptive_softmax = AdaptiveSoftmax(size, list(adaptive_cutoffs) + [self.target_vocab_size],
+                                               factor=adaptive_factor, initializer=weight_initializer(),
+                                               dtype=dtype)
+            softmax_loss_function = adaptive_softmax.loss
+            projection_function = adaptive_softmax.log_probs
         # Sampled softmax only makes sense if we sample less than vocabulary size.
-        if num_samples > 0 and num_samples < self.target_vocab_size:
+        elif num_samples > 0 and num_samples < self.target_vocab_size:
             w_t = tf.get_variable("proj_w", [self.target_vocab_size, size], dtype=dtype,
                                   initializer=weight_initializer())
             w = tf.transpose(w_t)
             b = tf.get_variable("proj_b", [self.target_vocab_size], dtype=dtype, initializer=bias_initializer)
             output_projection = (w, b)
+            self.proj_w = w_t
+
+            if quantize_projection and forward_only:
+                # Filled by quantize() from the restored float proj_w, so they
+                # are kept out of the checkpoint.
+                self.proj_w_q = tf.Variable(tf.zeros([self.target_vocab_size, size], dtype=tf.uint8),
+                                            trainable=False, name="proj_w_q")
+                self.proj_w_scales = tf.Variable(tf.ones([self.target_vocab_size], dtype=dtype),
+                                                 trainable=False, name="proj_w_scales")
+                quantized_variables = [self.proj_w_q, self.proj_w_scales]
+                self.proj_w_q_input = tf.placeholder(tf.uint8, shape=[self.target_vocab_size, size])
+                self.proj_w_scales_input = tf.placeholder(dtype, shape=[self.target_vocab_size])
+                self.quantize_ops = [tf.assign(self.proj_w_q, self.proj_w_q_input),
+                                     tf.assign(self.proj_w_scales, self.proj_w_scales_input)]
+
+                def projection_function(output, proj_b=b):
+                    return seq2seq_helper.quantized_xw_plus_b(output, self.proj_w_q, self.proj_w_scales, proj_b)
+
+            if shortlist_size > 0 and forward_only:
+                # Gather the shortlisted rows once per run; every decoding step
+                # then scores len(shortlist) rows instead of the whole vocabulary.
+                self.shortlist = tf.placeholder(tf.int32, shape=[None], name="shortlist")
+                symbol_map = self.shortlist
+                short_b = tf.gather(b, self.shortlist)
+                if quantize_projection:
+                    short_w_q = tf.gather(self.proj_w_q, self.shortlist)
+                    short_w_scales = tf.gather(self.proj_w_scales, self.shortlist)
+
+                    def projection_function(output):
+                        return seq2seq_helper.quantized_xw_plus_b(output, short_w_q, short_w_scales, short_b)
+                else:
+                    short_w_t = tf.gather(w_t, self.shortlist)
+
+                    def projection_function(output):
+                        return tf.matmul(output, short_w_t, transpose_b=True) + short_b
 
             def sampled_loss(inputs, labels):
                 labels = tf.reshape(labels, [-1, 1])
@@ -130,10 +256,17 @@ class Seq2SeqModel(object):
                 local_b = tf.cast(b, tf.float32)
                 local_inputs = tf.cast(inputs, tf.float32)
                 local_labels = tf.cast(labels, tf.float32)
+                sampled_values = None
+                if unigram_counts is not None:
+                    sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+                        true_classes=tf.cast(labels, tf.int64), num_true=1, num_sampled=num_samples,
+                        unique=True, range_max=self.target_vocab_size,
+                        distortion=unigram_distortion, unigrams=unigram_counts)
                 return tf.cast(
                     tf.nn.sampled_softmax_loss(weights=local_w_t, biases=local_b, inputs=local_inputs,
                                                labels=local_labels,
-                                               num_sampled=num_samples, num_classes=self.target_vocab_size),
+                                               num_sampled=num_samples, num_classes=self.target_vocab_size,
+                                               sampled_values=sampled_values),
                     dtype)
 
             softmax_loss_function = sampled_loss
@@ -162,7 +295,7 @@ class Seq2SeqModel(object):
                 weight_initializer=weight_initializer,
                 dtype=dtype)
 
-        def decoder_f(encoder_state, decoder_inputs):
+        def decoder_f(encoder_state, decoder_inputs, replace_input=replace_input):
             return seq2seq_helper.embedding_rnn_decoder(
                 decoder_inputs,
                 encoder_state,
@@ -174,7 +307,9 @@ class Seq2SeqModel(object):
                 embedding_size=size,
                 output_projection=output_projection,
                 feed_previous=feed_previous,
-                weight_initializer=weight_initializer)
+                weight_initializer=weight_initializer,
+                projection_function=projection_function,
+                symbol_map=symbol_map)
 
         def enc_latent_f(encoder_state):
             return seq2seq_helper.encoder_to_latent(
@@ -223,28 +358,59 @@ class Seq2SeqModel(object):
         # Our targets are decoder inputs shifted by one.
         targets = [self.decoder_inputs[i + 1]
                    for i in range(len(self.decoder_inputs) - 1)]
-
-        self.means, self.logvars = seq2seq_helper.variational_encoder_with_buckets(
-            self.encoder_inputs, buckets, encoder_f, enc_latent_f,
-            softmax_loss_function=softmax_loss_function)
-        self.outputs, self.losses, self.KL_objs, self.KL_costs = seq2seq_helper.variational_decoder_with_buckets(
-            self.means, self.logvars, self.decoder_inputs, targets,
-            self.target_weights, buckets, decoder_f, latent_dec_f,
-            sample_f, softmax_loss_function=softmax_loss_function)
+        self._mark_build("embeddings, projection and feeds")
+
+        if num_towers == 1:
+            self.means, self.logvars = seq2seq_helper.variational_encoder_with_buckets(
+                self.encoder_inputs, buckets, encoder_f, enc_latent_f,
+                softmax_loss_function=softmax_loss_function)
+            self._mark_build("encoder with buckets")
+            self.outputs, self.losses, self.KL_objs, self.KL_costs = seq2seq_helper.variational_decoder_with_buckets(
+                self.means, self.logvars, self.decoder_inputs, targets,
+                self.target_weights, buckets, decoder_f, latent_dec_f,
+                sample_f, softmax_loss_function=softmax_loss_function)
+            self._mark_build("decoder with buckets")
+        else:
+            self._build_towers(targets, replace_input, encoder_f, enc_latent_f,
+                               decoder_f, latent_dec_f, sample_f, softmax_loss_function)
+            self._mark_build("towers")
 
         # If we use output projection, we need to project outputs for decoding.
-        if output_projection is not None:
+        if projection_function is not None:
+            for b in range(len(buckets)):
+                self.outputs[b] = [projection_function(output) for output in self.outputs[b]]
+        elif output_projection is not None:
             for b in range(len(buckets)):
                 self.outputs[b] = [
                     tf.matmul(output, output_projection[0]) + output_projection[1]
                     for output in self.outputs[b]
                 ]
+        self._mark_build("output projection")
+
+        if iw_samples > 0:
+            if adaptive_cutoffs:
+                exact_loss_function = softmax_loss_function
+            else:
+                # Sampled softmax only bounds the likelihood; score the full vocabulary.
+                def exact_loss_function(output, target):
+                    if projection_function is not None:
+                        output = projection_function(output)
+                    elif output_projection is not None:
+                        output = tf.matmul(output, output_projection[0]) + output_projection[1]
+                    return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.reshape(target, [-1]),
+                                                                          logits=output)
+            self._build_importance_weighted(iw_samples, targets, replace_input, decoder_f, latent_dec_f,
+                                            latent_dim, iaf, exact_loss_function, dtype)
+            self._mark_build("importance weighted bounds")
+
         # Gradients and SGD update operation for training the model.
         params = tf.trainable_variables()
         if not forward_only:
             self.gradient_norms = []
             self.updates = []
             for b in range(len(buckets)):
+                # With towers the losses are tower means, so these are the
+                # tower-averaged gradients and clipping sees the averaged norm.
                 total_loss = self.losses[b] + self.KL_objs[b]
                 gradients = tf.gradients(total_loss, params)
                 clipped_gradients, norm = tf.clip_by_global_norm(gradients,
@@ -252,8 +418,171 @@ class Seq2SeqModel(object):
                 self.gradient_norms.append(norm)
                 self.updates.append(optimizer.apply_gradients(
                     zip(clipped_gradients, params), global_step=self.global_step))
+                self._mark_build("gradients bucket %d" % b)
+
+        self.quantized = bool(quantized_variables)
+        self.saver_variables = [v for v in tf.global_variables() if v not in quantized_variables]
+        self.saver = tf.train.Saver(self.saver_variables, max_to_keep=3)
+        # A separate slot for the checkpoint with the best dev loss, which
+        # the recency-based saver above would eventually delete.
+        self.best_saver = tf.train.Saver(self.saver_variables, max_to_keep=1)
+        self._mark_build("savers")
+
+    def _mark_build(self, phase):
+        """Record the time and graph nodes taken since the previous phase ended."""
+        now, num_nodes = time.time(), len(tf.get_default_graph().get_operations())
+        last_time, last_num_nodes = self._build_mark
+        self.build_phases.append((phase, now - last_time, num_nodes - last_num_nodes))
+        self._build_mark = (now, num_nodes)
+
+    def load_embeddings(self, session, embedding_matrix):
+        """Assign a [vocab_size x size] matrix to the encoder and decoder embeddings."""
+        session.run(self.embedding_init_ops, {self.embedding_input: embedding_matrix})
+
+    def restore(self, session, checkpoint_path):
+        """Restore the model, also from a checkpoint saved with the other share_embeddings setting.
+
+        A shared "embedding" is restored from an older checkpoint's
+        "enc_embedding" (both embeddings were loaded with the same matrix), and
+        separate embeddings are both restored from a shared "embedding".
+        """
+        saved = tf.train.NewCheckpointReader(checkpoint_path).get_variable_to_shape_map()
+        var_list = dict((v.op.name, v) for v in self.saver_variables)
+        if self.share_embeddings and "embedding" not in saved and "enc_embedding" in saved:
+            var_list["enc_embedding"] = var_list.pop("embedding")
+        elif not self.share_embeddings and "embedding" in saved and "enc_embedding" not in saved:
+            var_list["embedding"] = var_list.pop("enc_embedding")
+            del var_list["dec_embedding"]
+        else:
+            self.saver.restore(session, checkpoint_path)
+            return
+        tf.train.Saver(var_list).restore(session, checkpoint_path)
+        if "embedding" in var_list:
+            session.run(tf.assign(self.dec_embedding, self.enc_embedding))
+
+    def export_inference(self, session, path, float16=False):
+        """Save only the variables this (forward-only) model restores, without optimizer slots.
 
-        self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=3)
+        Float32 values are stored as float16 if float16 is set; they are cast
+        back by restore_inference.
+
+        Returns:
+          the path prefix of the written checkpoint.
+        """
+        values = session.run(self.saver_variables)
+        with tf.Graph().as_default():
+            var_list, feeds = {}, {}
+            for var, value in zip(self.saver_variables, values):
+                value = np.asarray(value)
+                if float16 and value.dtype == np.float32:
+                    value = value.astype(np.float16)
+                value_input = tf.placeholder(value.dtype, shape=value.shape)
+                var_list[var.op.name] = tf.Variable(value_input, trainable=False)
+                feeds[value_input] = value
+            with tf.Session() as export_session:
+                export_session.run(tf.global_variables_initializer(), feeds)
+                return tf.train.Saver(var_list).save(export_session, path, write_meta_graph=False)
+
+    def restore_inference(self, session, path):
+        """Restore from a checkpoint written by export_inference.
+
+        Raises:
+          ValueError: if the checkpoint lacks some of the model's variables.
+        """
+        reader = tf.train.NewCheckpointReader(path)
+        saved = reader.get_variable_to_shape_map()
+        missing = [var.op.name for var in self.saver_variables if var.op.name not in saved]
+        if missing:
+            raise ValueError("Inference checkpoint %s lacks variables: %s." % (path, ", ".join(missing)))
+        for var in self.saver_variables:
+            var.load(reader.get_tensor(var.op.name).astype(var.dtype.base_dtype.as_numpy_dtype), session)
+
+    def quantize(self, session):
+        """Fill the int8 output projection from the float proj_w in session."""
+        q, scales = quantize_rows(session.run(self.proj_w))
+        session.run(self.quantize_ops, {self.proj_w_q_input: q, self.proj_w_scales_input: scales})
+
+    def _build_towers(self, targets, replace_input, encoder_f, enc_latent_f,
+                      decoder_f, latent_dec_f, sample_f, softmax_loss_function):
+        """Build num_towers replicas of the bucketed model sharing variables.
+
+        Every feed is split along the batch dimension. Per-tower means and
+        logvars are concatenated into self.means / self.logvars and split again
+        before decoding, so feeding those tensors (as step and decode_from_latent
+        do) still overrides the latent for every tower. Outputs are concatenated
+        back into full-batch tensors and losses are averaged over towers.
+        """
+        buckets = self.buckets
+        num_towers = self.num_towers
+
+        def split(tensors):
+            return list(zip(*[tf.split(t, num_towers) for t in tensors]))
+
+        tower_encoder_inputs = split(self.encoder_inputs)
+        tower_decoder_inputs = split(self.decoder_inputs)
+        tower_targets = split(targets)
+        tower_weights = split(self.target_weights)
+        tower_replace_input = tf.split(replace_input, num_towers)
+
+        tower_means, tower_logvars = [], []
+        for t in range(num_towers):
+            with tf.name_scope("tower_%d" % t), tf.variable_scope(tf.get_variable_scope(),
+                                                                  reuse=True if t > 0 else None):
+                means, logvars = seq2seq_helper.variational_encoder_with_buckets(
+                    list(tower_encoder_inputs[t]), buckets, encoder_f, enc_latent_f,
+                    softmax_loss_function=softmax_loss_function)
+                tower_means.append(means)
+                tower_logvars.append(logvars)
+        self.means = [tf.concat([m[b] for m in tower_means], 0) for b in range(len(buckets))]
+        self.logvars = [tf.concat([l[b] for l in tower_logvars], 0) for b in range(len(buckets))]
+        split_means = [tf.split(m, num_towers) for m in self.means]
+        split_logvars = [tf.split(l, num_towers) for l in self.logvars]
+
+        tower_results = []
+        for t in range(num_towers):
+            def tower_decoder_f(encoder_state, decoder_inputs, replace_input=tower_replace_input[t]):
+                return decoder_f(encoder_state, decoder_inputs, replace_input)
+
+            with tf.name_scope("tower_%d" % t), tf.variable_scope(tf.get_variable_scope(),
+                                                                  reuse=True if t > 0 else None):
+                tower_results.append(seq2seq_helper.variational_decoder_with_buckets(
+                    [m[t] for m in split_means], [l[t] for l in split_logvars],
+                    list(tower_decoder_inputs[t]), list(tower_targets[t]), list(tower_weights[t]),
+                    buckets, tower_decoder_f, latent_dec_f, sample_f,
+                    softmax_loss_function=softmax_loss_function))
+
+        self.outputs, self.losses, self.KL_objs, self.KL_costs = [], [], [], []
+        for b in range(len(buckets)):
+            self.outputs.append([tf.concat([r[0][b][i] for r in tower_results], 0)
+                                 for i in range(len(tower_results[0][0][b]))])
+            self.losses.append(tf.add_n([r[1][b] for r in tower_results]) / num_towers)
+            self.KL_objs.append(tf.add_n([r[2][b] for r in tower_results]) / num_towers)
+            self.KL_costs.append(tf.add_n([r[3][b] for r in tower_results]) / num_towers)
+
+    def _build_importance_weighted(self, k, targets, replace_input, decoder_f, latent_dec_f,
+                                   latent_dim, iaf, loss_function, dtype):
+        """Build per-example bounds on -log p(x) (in nats) from k samples, for every bucket.
+
+        Every example is tiled k times in-graph. self.iw_bounds[b] holds the
+        importance-weighted bound from compute_lowerbound and self.iw_elbos[b]
+        the single-sample bound averaged over the same k samples.
+        """
+        self.iw_samples = k
+        self.iw_bounds, self.iw_elbos = [], []
+        tiled_replace_input = repeat(replace_input, k)
+        with tf.name_scope("importance_weighted"), tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            for b, (_, decoder_size) in enumerate(self.buckets):
+                latent_vector, log_ratio = seq2seq_helper.sample_log_weights(
+                    repeat(self.means[b], k), repeat(self.logvars[b], k), latent_dim, iaf, dtype)
+                outputs, _ = decoder_f(latent_dec_f(latent_vector),
+                                       [repeat(inp, k) for inp in self.decoder_inputs[:decoder_size]],
+                                       replace_input=tiled_replace_input)
+                log_pxz = -seq2seq_helper.sequence_loss_by_example(
+                    outputs, [repeat(target, k) for target in targets[:decoder_size]],
+                    [repeat(weight, k) for weight in self.target_weights[:decoder_size]],
+                    average_across_timesteps=False, softmax_loss_function=loss_function)
+                self.iw_bounds.append(compute_lowerbound(log_pxz, log_ratio, k))
+                self.iw_elbos.append(tf.reduce_mean(tf.reshape(log_ratio - log_pxz, [-1, k]), [1]))
 
     def step(self, session, encoder_inputs, decoder_inputs, target_weights,
              bucket_id, forward_only, prob, beam_size=1):
@@ -287,39 +616,69 @@ class Seq2SeqModel(object):
             raise ValueError("Weights length must be equal to the one in bucket,"
                              " %d != %d." % (len(target_weights), decoder_size))
 
-        # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
-        input_feed = {}
-        for l in range(encoder_size):
-            input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
-        for l in range(decoder_size):
-            input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-            input_feed[self.target_weights[l].name] = target_weights[l]
-        if self.word_dropout_keep_prob < 1:
-            input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
-
-        # Since our targets are decoder inputs shifted by one, we need one more.
-        last_target = self.decoder_inputs[decoder_size].name
-        input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
-        if not prob:
-            input_feed[self.logvars[bucket_id]] = np.full((self.batch_size, self.latent_dim), -800.0, dtype=np.float32)
-
-        # Output feed: depends on whether we do a backward step or not.
-        if not forward_only:
-            output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
-                           self.gradient_norms[bucket_id],  # Gradient norm.
-                           self.losses[bucket_id],
-                           self.KL_costs[bucket_id]]  # Loss for this batch.
-        else:
-            output_feed = [self.losses[bucket_id], self.KL_costs[bucket_id]]  # Loss for this batch.
-            for l in range(decoder_size):  # Output logits.
-                output_feed.append(self.outputs[bucket_id][l])
+        with self.profiler.phase("feed"):
+            # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
+            input_feed = {}
+            for l in range(encoder_size):
+                input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+            for l in range(decoder_size):
+                input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+                input_feed[self.target_weights[l].name] = target_weights[l]
+            if self.word_dropout_keep_prob < 1:
+                input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
+            if self.shortlist_size:
+                input_feed[self.shortlist] = self._make_shortlist(encoder_inputs)
+
+            # Since our targets are decoder inputs shifted by one, we need one more.
+            last_target = self.decoder_inputs[decoder_size].name
+            input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+            if not prob:
+                input_feed[self.logvars[bucket_id]] = np.full((self.batch_size, self.latent_dim), -800.0,
+                                                              dtype=np.float32)
+
+            # Output feed: depends on whether we do a backward step or not.
+            if not forward_only:
+                output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
+                               self.gradient_norms[bucket_id],  # Gradient norm.
+                               self.losses[bucket_id],
+                               self.KL_costs[bucket_id]]  # Loss for this batch.
+            else:
+                output_feed = [self.losses[bucket_id], self.KL_costs[bucket_id]]  # Loss for this batch.
+                for l in range(decoder_size):  # Output logits.
+                    output_feed.append(self.outputs[bucket_id][l])
 
-        outputs = session.run(output_feed, input_feed)
+        with self.profiler.phase("session.run"):
+            outputs = session.run(output_feed, input_feed, **self.profiler.run_kwargs())
         if not forward_only:
             return outputs[1], outputs[2], outputs[3], None  # Gradient norm, loss, KL divergence, no outputs.
         else:
             return None, outputs[0], outputs[1], outputs[2:]  # no gradient norm, loss, KL divergence, outputs.
 
+    def importance_weighted_step(self, session, encoder_inputs, decoder_inputs, target_weights, bucket_id):
+        """Bounds on -log p(x) of every example in the batch; needs iw_samples > 0.
+
+        Returns:
+          A pair of [batch_size] arrays: the iw_samples-sample importance-weighted
+          bound and the single-sample bound (negative ELBO), both in nats.
+        """
+        encoder_size, decoder_size = self.buckets[bucket_id]
+        with self.profiler.phase("feed"):
+            input_feed = {}
+            for l in range(encoder_size):
+                input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+            for l in range(decoder_size):
+                input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+                input_feed[self.target_weights[l].name] = target_weights[l]
+            if self.word_dropout_keep_prob < 1:
+                input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
+            last_target = self.decoder_inputs[decoder_size].name
+            input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+            output_feed = [self.iw_bounds[bucket_id], self.iw_elbos[bucket_id]]
+
+        with self.profiler.phase("session.run"):
+            bounds, elbos = session.run(output_feed, input_feed, **self.profiler.run_kwargs())
+        return bounds, elbos
+
     def encode_to_latent(self, session, encoder_inputs, bucket_id):
 
         # Check if the sizes match.
@@ -328,37 +687,66 @@ class Seq2SeqModel(object):
             raise ValueError("Encoder length must be equal to the one in bucket,"
                              " %d != %d." % (len(encoder_inputs), encoder_size))
 
-        input_feed = {}
-        for l in range(encoder_size):
-            input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+        with self.profiler.phase("feed"):
+            input_feed = {}
+            for l in range(encoder_size):
+                input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
 
-        output_feed = [self.means[bucket_id], self.logvars[bucket_id]]
-        means, logvars = session.run(output_feed, input_feed)
+            output_feed = [self.means[bucket_id], self.logvars[bucket_id]]
+        with self.profiler.phase("session.run"):
+            means, logvars = session.run(output_feed, input_feed, **self.profiler.run_kwargs())
 
         return means, logvars
 
     def decode_from_latent(self, session, means, logvars, bucket_id, decoder_inputs, target_weights):
 
         _, decoder_size = self.buckets[bucket_id]
-        # Input feed: means.
-        input_feed = {self.means[bucket_id]: means}
-        input_feed[self.logvars[bucket_id]] = logvars
+        with self.profiler.phase("feed"):
+            # Input feed: means.
+            input_feed = {self.means[bucket_id]: means}
+            input_feed[self.logvars[bucket_id]] = logvars
+
+            for l in range(decoder_size):
+                input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
+                input_feed[self.target_weights[l].name] = target_weights[l]
+            if self.word_dropout_keep_prob < 1:
+                input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
+            if self.shortlist_size:
+                input_feed[self.shortlist] = self._make_shortlist()
+
+            last_target = self.decoder_inputs[decoder_size].name
+            input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+            output_feed = []
+            for l in range(decoder_size):  # Output logits.
+                output_feed.append(self.outputs[bucket_id][l])
 
-        for l in range(decoder_size):
-            input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-            input_feed[self.target_weights[l].name] = target_weights[l]
-        if self.word_dropout_keep_prob < 1:
-            input_feed[self.replace_input.name] = np.full((self.batch_size), data_utils.UNK_ID, dtype=np.int32)
+        with self.profiler.phase("session.run"):
+            outputs = session.run(output_feed, input_feed, **self.profiler.run_kwargs())
 
-        last_target = self.decoder_inputs[decoder_size].name
-        input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
-        output_feed = []
-        for l in range(decoder_size):  # Output logits.
-            output_feed.append(self.outputs[bucket_id][l])
+        return outputs
 
-        outputs = session.run(output_feed, input_feed)
+    def _make_shortlist(self, encoder_inputs=()):
+        """Sorted ids of the shortlist_size most frequent tokens and the input tokens.
 
-        return outputs
+        Vocabulary ids are assigned in order of decreasing frequency, so the
+        most frequent tokens are simply the lowest ids.
+        """
+        shortlist = np.arange(min(self.shortlist_size, self.target_vocab_size), dtype=np.int32)
+        if len(encoder_inputs):
+            shortlist = np.union1d(shortlist, np.concatenate(encoder_inputs)).astype(np.int32)
+        self.shortlist_ids = shortlist
+        return shortlist
+
+    def output_ids(self, output_logits):
+        """Greedy token ids from the output logits of the last step or decode_from_latent call.
+
+        Returns a list with one [batch_size] int array per time step, mapped back
+        to full vocabulary ids when decoding over a shortlist.
+        """
+        ids = [np.argmax(logit, axis=1) for logit in output_logits]
+        if self.shortlist_size:
+            ids = [self.shortlist_ids[i] for i in ids]
+        return ids
 
     def get_batch(self, data, bucket_id):
         """Get a random batch of data from the specified bucket, prepare for step.
@@ -376,14 +764,27 @@ class Seq2SeqModel(object):
           The triple (encoder_inputs, decoder_inputs, target_weights) for
           the constructed batch that has the proper format to call step(...) later.
         """
+        # Get a random batch of encoder and decoder inputs from data.
+        return self.make_batch([random.choice(data[bucket_id]) for _ in range(self.batch_size)], bucket_id)
+
+    def make_batch(self, examples, bucket_id):
+        """Prepare the given examples for step, in order.
+
+        Args:
+          examples: a list of at most batch_size (encoder_input, decoder_input)
+            pairs of token-id lists. Shorter lists are filled up with empty
+            examples, whose rows callers should ignore.
+          bucket_id: integer, which bucket to build the batch for.
+
+        Returns:
+          The triple (encoder_inputs, decoder_inputs, target_weights), as get_batch.
+        """
         encoder_size, decoder_size = self.buckets[bucket_id]
         encoder_inputs, decoder_inputs = [], []
+        examples = list(examples) + [([], [])] * (self.batch_size - len(examples))
 
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for _ in range(self.batch_size):
-            encoder_input, decoder_input = random.choice(data[bucket_id])
-
+        # Pad them if needed, reverse encoder inputs and add GO to decoder.
+        for encoder_input, decoder_input in examples:
             # Encoder inputs are padded and then reversed.
             encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
             encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the repository's modules as the scripts at its root do.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,169 @@
+import collections
+import gzip
+import random
+
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from utils import data_utils
+
+BPE_CORPUS = ["low low low low low", "lower lower newest newest newest",
+              "newest newest newest widest widest widest"]
+
+
+def write_lines(path, lines):
+    with open(str(path), "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def naive_bpe(lines, num_merges, min_frequency=2):
+    """Reference BPE that recounts all pairs before every merge."""
+    word_counts = collections.Counter(w for line in lines for w in data_utils.basic_tokenizer(line))
+    words = dict((data_utils._bpe_symbols(w), c) for w, c in word_counts.items())
+    merges = []
+    while len(merges) < num_merges:
+        stats = collections.Counter()
+        for symbols, count in words.items():
+            for pair in zip(symbols, symbols[1:]):
+                stats[pair] += count
+        if not stats:
+            break
+        best = min(stats, key=lambda pair: (-stats[pair], pair))
+        if stats[best] < min_frequency:
+            break
+        merges.append(best)
+        words = dict((data_utils._bpe_merge(symbols, best), count) for symbols, count in words.items())
+    return merges
+
+
+def test_learn_bpe_merges_the_most_frequent_pair_first(tmp_path):
+    path = write_lines(tmp_path / "train.txt", BPE_CORPUS)
+    merges = data_utils.learn_bpe(path, 2)
+    assert merges == [("e", "s"), ("es", "t</w>")]
+
+
+def test_learn_bpe_matches_recounting_every_merge(tmp_path):
+    rng = random.Random(0)
+    alphabet = "abcde"
+    vocab = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 7))) for _ in range(60)]
+    lines = [" ".join(rng.choice(vocab) for _ in range(12)) for _ in range(200)]
+    path = write_lines(tmp_path / "train.txt", lines)
+    assert data_utils.learn_bpe(path, 100) == naive_bpe(lines, 100)
+
+
+def test_learn_bpe_stops_below_min_frequency(tmp_path):
+    path = write_lines(tmp_path / "train.txt", ["ab cd"])
+    assert data_utils.learn_bpe(path, 10) == []
+    assert data_utils.learn_bpe(path, 10, min_frequency=1) == naive_bpe(["ab cd"], 10, min_frequency=1)
+
+
+def test_bpe_tokenizer_splits_and_detokenizes(tmp_path):
+    codes_path = str(tmp_path / "bpe.codes")
+    data_utils.create_bpe_codes(codes_path, write_lines(tmp_path / "train.txt", BPE_CORPUS), 10)
+    tokenizer = data_utils.BPETokenizer(codes_path)
+    assert tokenizer("newest widest") == ["newest", "widest"]
+    tokens = tokenizer("lowest newer")
+    assert tokens == ["lo@@", "w@@", "est", "n@@", "ew@@", "e@@", "r"]
+    assert data_utils.bpe_detokenize(tokens) == "lowest newer"
+
+
+def test_bpe_tokenizer_normalizes_digits(tmp_path):
+    codes_path = write_lines(tmp_path / "bpe.codes", ["0 0</w>"])
+    assert data_utils.BPETokenizer(codes_path)("42") == ["00"]
+    assert data_utils.BPETokenizer(codes_path, normalize_digits=False)("42") == ["4@@", "2"]
+
+
+def test_bpe_tokenizer_needs_codes(tmp_path):
+    with pytest.raises(ValueError):
+        data_utils.BPETokenizer(str(tmp_path / "missing.codes"))
+
+
+def test_open_corpus_decompresses_gz(tmp_path):
+    path = str(tmp_path / "train.txt.gz")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("first line\nsecond line \u00e9\n")
+    with data_utils.open_corpus(path) as f:
+        assert f.read() == "first line\nsecond line \u00e9\n"
+
+
+def test_corpus_lines_reads_plain_and_gz_shards_in_order(tmp_path):
+    plain = write_lines(tmp_path / "part-0.txt", ["a b", "c"])
+    compressed = str(tmp_path / "part-1.txt.gz")
+    with gzip.open(compressed, "wt", encoding="utf-8") as f:
+        f.write("d e\n")
+    assert list(data_utils.corpus_lines([plain, compressed])) == ["a b\n", "c\n", "d e\n"]
+    assert list(data_utils.corpus_lines(compressed)) == ["d e\n"]
+
+
+def test_corpus_path_finds_the_compressed_file(tmp_path):
+    write_lines(tmp_path / "dev.txt.gz", [])
+    assert data_utils.corpus_path(str(tmp_path), "dev.txt") == str(tmp_path / "dev.txt.gz")
+    write_lines(tmp_path / "dev.txt", [])
+    assert data_utils.corpus_path(str(tmp_path), "dev.txt") == str(tmp_path / "dev.txt")
+
+
+def test_learn_bpe_reads_gz(tmp_path):
+    compressed = str(tmp_path / "train.txt.gz")
+    with gzip.open(compressed, "wt", encoding="utf-8") as f:
+        f.write("".join(line + "\n" for line in BPE_CORPUS))
+    assert data_utils.learn_bpe(compressed, 5) == data_utils.learn_bpe(
+        write_lines(tmp_path / "train.txt", BPE_CORPUS), 5)
+
+
+def read_counts(path):
+    with open(path) as f:
+        return [int(line) for line in f]
+
+
+def test_create_vocabulary_writes_counts_without_zeros(tmp_path):
+    data_path = write_lines(tmp_path / "train.txt", ["a a a b", "a b c", "d"])
+    vocab_path = str(tmp_path / "vocab6")
+    data_utils.create_vocabulary(vocab_path, data_path, 6, str(tmp_path / "embedding6"))
+    _, vocab = data_utils.initialize_vocabulary(vocab_path)
+    assert vocab == ["_PAD", "_GO", "_EOS", "_UNK", "a", "b"]
+    counts = read_counts(data_utils.counts_path(vocab_path))
+    # _PAD and _GO never occur but are floored at 1; _UNK gets the cut-off "c" and "d".
+    assert counts == [1, 1, 3, 2, 4, 2]
+
+
+def test_counts_from_token_ids_have_no_zeros(tmp_path):
+    ids_path = write_lines(tmp_path / "train.ids6", ["4 4 5", "4"])
+    counts_path = str(tmp_path / "vocab6.counts")
+    data_utils.create_counts_from_token_ids(counts_path, ids_path, 6)
+    assert read_counts(counts_path) == [1, 1, 2, 1, 3, 1]
+
+
+def test_load_counts_floors_and_pads_with_ones(tmp_path):
+    counts_path = write_lines(tmp_path / "vocab6.counts", ["0", "0", "7", "3"])
+    assert data_utils.load_counts(counts_path, 6) == [1, 1, 7, 3, 1, 1]
+    assert data_utils.load_counts(counts_path, 3) == [1, 1, 7]
+
+
+def test_prepare_eval_data_tokenizes_with_the_training_vocabulary(tmp_path):
+    data_dir = str(tmp_path)
+    data_utils.create_vocabulary(data_utils.vocabulary_path(data_dir, 6), write_lines(tmp_path / "train.txt", [
+        "a a a b", "a b c"]), 6, str(tmp_path / "embedding6.tsv"))
+    with gzip.open(str(tmp_path / "test.txt.gz"), "wt", encoding="utf-8") as f:
+        f.write("b a z\n")
+    ids_path = data_utils.prepare_eval_data(data_dir, "test.txt", 6)
+    assert ids_path == str(tmp_path / "test.txt.ids6")
+    assert read_ids(ids_path) == [5, 4, data_utils.UNK_ID]
+    with pytest.raises(ValueError):
+        data_utils.prepare_eval_data(data_dir, "missing.txt", 6)
+
+
+def read_ids(path):
+    with open(path) as f:
+        return [int(tok) for tok in f.read().split()]
+
+
+def test_prepared_files_are_renamed_into_place(tmp_path):
+    write_lines(tmp_path / "train.txt", ["a a b", "c"])
+    write_lines(tmp_path / "dev.txt", ["a c"])
+    data_utils.prepare_wmt_data(str(tmp_path), 6, bpe_merges=2)
+    names = sorted(p.name for p in tmp_path.iterdir())
+    assert not [name for name in names if name.endswith(".tmp")]
+    assert names == ["bpe2.codes", "dev.txt", "dev.txt.ids6.bpe2", "embedding6.bpe2.tsv", "train.txt",
+                     "train.txt.ids6.bpe2", "vocab6.bpe2", "vocab6.bpe2.counts"]
@@ -0,0 +1,72 @@
+import json
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.epoch_sampler import EpochSampler
+
+BUCKET_SIZES = [7, 0, 12, 3]
+BATCH_SIZE = 4
+
+
+def draw(sampler, num_batches):
+    return [(bucket_id, list(indices)) for bucket_id, indices in
+            (sampler.next_batch() for _ in range(num_batches))]
+
+
+def batches_per_epoch():
+    return sum(-(-size // BATCH_SIZE) for size in BUCKET_SIZES)
+
+
+def test_an_epoch_visits_every_example():
+    sampler = EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3)
+    seen = [set() for _ in BUCKET_SIZES]
+    for bucket_id, indices in draw(sampler, batches_per_epoch()):
+        assert len(indices) == BATCH_SIZE
+        seen[bucket_id].update(indices)
+    assert seen == [set(range(size)) for size in BUCKET_SIZES]
+    assert sampler.epochs() == 1.0
+    sampler.next_batch()
+    assert (sampler.epoch, sampler.cursor) == (1, 1)
+
+
+def test_order_depends_only_on_seed_and_epoch():
+    first = draw(EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3), 2 * batches_per_epoch())
+    assert first == draw(EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3), 2 * batches_per_epoch())
+    assert first != draw(EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=4), 2 * batches_per_epoch())
+    assert first[batches_per_epoch():] == draw(
+        EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3, epoch=1), batches_per_epoch())
+
+
+def test_restore_continues_the_order_and_rng_states():
+    shards = ["train.ids.part-0", "train.ids.part-1"]
+    sampler = EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3, shards=shards)
+    draw(sampler, 5)
+    state = json.loads(json.dumps(sampler.state()))
+    expected = draw(sampler, 2 * batches_per_epoch())
+    expected_random, expected_numpy = random.random(), np.random.rand()
+
+    random.seed(0)
+    np.random.seed(0)
+    restored = EpochSampler.restore(state, BUCKET_SIZES, BATCH_SIZE, shards)
+    assert (random.random(), np.random.rand()) == (expected_random, expected_numpy)
+    assert draw(restored, 2 * batches_per_epoch()) == expected
+
+
+@pytest.mark.parametrize("shards, bucket_sizes", [
+    (["train.ids.part-0"], BUCKET_SIZES),
+    (["train.ids.part-0", "train.ids.part-1"], [7, 0, 13, 3]),
+])
+def test_restore_with_other_data_starts_the_next_epoch(shards, bucket_sizes):
+    sampler = EpochSampler(BUCKET_SIZES, BATCH_SIZE, seed=3, shards=["train.ids.part-0", "train.ids.part-1"])
+    draw(sampler, 5)
+    restored = EpochSampler.restore(sampler.state(), bucket_sizes, BATCH_SIZE, shards)
+    assert (restored.epoch, restored.cursor) == (1, 0)
+    assert restored.bucket_sizes == bucket_sizes
+
+
+def test_empty_buckets_are_rejected():
+    with pytest.raises(ValueError):
+        EpochSampler([0, 0], BATCH_SIZE)
@@ -0,0 +1,43 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.interpolation import lerp, slerp
+
+
+def test_lerp_is_evenly_spaced_between_the_endpoints():
+    start = np.array([[0.0, 0.0], [1.0, 2.0]])
+    end = np.array([[4.0, 8.0], [1.0, -2.0]])
+    points = lerp(start, end, 5)
+    assert points.shape == (2, 5, 2)
+    np.testing.assert_allclose(points[:, 0], start)
+    np.testing.assert_allclose(points[:, -1], end)
+    np.testing.assert_allclose(points[0], [[0, 0], [1, 2], [2, 4], [3, 6], [4, 8]])
+
+
+def test_slerp_follows_the_great_circle():
+    start = np.array([[1.0, 0.0], [0.0, 3.0]])
+    end = np.array([[0.0, 1.0], [3.0, 0.0]])
+    points = slerp(start, end, 3)
+    assert points.shape == (2, 3, 2)
+    np.testing.assert_allclose(points[:, 0], start, atol=1e-7)
+    np.testing.assert_allclose(points[:, -1], end, atol=1e-7)
+    # Between two orthogonal vectors of equal norm, every point keeps that norm.
+    np.testing.assert_allclose(np.linalg.norm(points, axis=2), [[1.0] * 3, [3.0] * 3])
+    np.testing.assert_allclose(points[0, 1], [np.sqrt(0.5), np.sqrt(0.5)])
+
+
+def test_slerp_falls_back_to_lerp_for_parallel_pairs():
+    start = np.array([[1.0, 2.0], [1.0, 1.0]])
+    end = np.array([[2.0, 4.0], [-1.0, -1.0]])
+    points = slerp(start, end, 4)
+    assert np.all(np.isfinite(points))
+    np.testing.assert_allclose(points, lerp(start, end, 4))
+
+
+def test_slerp_keeps_pairs_independent():
+    rng = np.random.RandomState(0)
+    start, end = rng.randn(6, 8), rng.randn(6, 8)
+    batched = slerp(start, end, 7)
+    for i in range(6):
+        np.testing.assert_allclose(batched[i], slerp(start[i:i + 1], end[i:i + 1], 7)[0])
@@ -0,0 +1,80 @@
+import pytest
+
+from utils.lru_cache import LRUCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_evicts_the_least_recently_used_entry():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used.
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_put_refreshes_an_existing_key():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert cache.get("a") == 10
+    assert cache.get("b") is None
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = LRUCache(4, ttl=10, clock=clock)
+    cache.put("a", 1)
+    clock.now = 10
+    assert cache.get("a") == 1
+    clock.now = 10.5
+    assert cache.get("a") is None
+    assert cache.expirations == 1 and not cache.entries
+
+
+def test_zero_ttl_never_expires():
+    clock = FakeClock()
+    cache = LRUCache(4, clock=clock)
+    cache.put("a", 1)
+    clock.now = 1e9
+    assert cache.get("a") == 1
+
+
+def test_new_checkpoint_drops_all_entries():
+    cache = LRUCache(4)
+    cache.set_checkpoint("ckpt-1")
+    cache.put("a", 1)
+    cache.set_checkpoint("ckpt-1")
+    assert cache.get("a") == 1
+    cache.set_checkpoint("ckpt-2")
+    assert cache.get("a") is None
+    assert cache.invalidations == 1
+
+
+def test_hit_rate_and_summary():
+    cache = LRUCache(4)
+    assert cache.hit_rate() == 0.0
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+    assert cache.hits == 2 and cache.misses == 1
+    assert cache.hit_rate() == pytest.approx(2 / 3.0)
+    assert "hit rate 66.7%" in cache.summary()
+
+
+def test_max_size_must_be_positive():
+    with pytest.raises(ValueError):
+        LRUCache(0)
@@ -0,0 +1,30 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from utils.quantization import dequantize_rows, quantize_rows
+
+
+def test_round_trip_error_is_at_most_half_a_step():
+    w = np.random.RandomState(0).randn(16, 40).astype(np.float32)
+    q, scales = quantize_rows(w)
+    assert q.dtype == np.uint8 and scales.dtype == np.float32
+    assert scales.shape == (16,)
+    error = np.abs(dequantize_rows(q, scales) - w)
+    assert np.all(error <= scales[:, None] / 2 + 1e-6)
+
+
+def test_row_maximum_maps_to_the_end_of_the_range():
+    w = np.array([[1.0, -0.5, 0.25], [-4.0, 2.0, 0.0]], dtype=np.float32)
+    q, scales = quantize_rows(w)
+    np.testing.assert_allclose(scales, [1.0 / 127, 4.0 / 127])
+    assert q[0, 0] == 128 + 127
+    assert q[1, 0] == 128 - 127
+    np.testing.assert_allclose(dequantize_rows(q, scales)[:, 0], [1.0, -4.0], rtol=1e-6)
+
+
+def test_zero_row_keeps_a_unit_scale():
+    q, scales = quantize_rows(np.zeros((2, 5)))
+    np.testing.assert_array_equal(scales, [1.0, 1.0])
+    np.testing.assert_array_equal(q, 128)
+    np.testing.assert_array_equal(dequantize_rows(q, scales), 0.0)
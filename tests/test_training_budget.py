@@ -0,0 +1,52 @@
+from utils.training_budget import TrainingBudget
+
+
+def test_no_limits_never_stop():
+    budget = TrainingBudget()
+    for step in range(5):
+        budget.record_eval(step, 1.0)
+    assert budget.exhausted(10 ** 9, 10 ** 9, 10 ** 9) is None
+
+
+def test_max_steps():
+    budget = TrainingBudget(max_steps=100)
+    assert budget.exhausted(99, 0, 0) is None
+    assert budget.exhausted(100, 0, 0) == "reached max_steps 100"
+
+
+def test_max_time():
+    budget = TrainingBudget(max_time=60)
+    assert budget.exhausted(0, 59.9, 0) is None
+    assert budget.exhausted(0, 60, 0) == "reached max_time 60s"
+
+
+def test_max_epochs_counts_fractional_epochs():
+    budget = TrainingBudget(max_epochs=1.5)
+    assert budget.exhausted(0, 0, 1.49) is None
+    assert budget.exhausted(0, 0, 1.5) == "reached max_epochs 1.5"
+
+
+def test_patience_counts_evals_since_the_best():
+    budget = TrainingBudget(patience=2)
+    assert budget.record_eval(100, 5.0)
+    assert not budget.record_eval(200, 5.0)  # Only strictly lower is better.
+    assert budget.exhausted(200, 0, 0) is None
+    assert budget.record_eval(300, 4.0)
+    assert not budget.record_eval(400, 4.5)
+    assert budget.exhausted(400, 0, 0) is None
+    assert not budget.record_eval(500, 4.1)
+    assert budget.exhausted(500, 0, 0) == "no dev improvement in 2 evaluations since step 300"
+    assert (budget.best_loss, budget.best_step) == (4.0, 300)
+
+
+def test_resumed_best_loss_must_be_beaten():
+    budget = TrainingBudget(patience=1, best_loss=3.0, best_step=50)
+    assert not budget.record_eval(100, 3.5)
+    assert budget.exhausted(100, 0, 0) == "no dev improvement in 1 evaluations since step 50"
+    assert budget.record_eval(200, 2.0)
+    assert budget.best_step == 200
+
+
+def test_limits_are_reported_in_order():
+    budget = TrainingBudget(max_steps=10, max_time=10)
+    assert budget.exhausted(10, 10, 0) == "reached max_steps 10"
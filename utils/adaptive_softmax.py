@@ -0,0 +1,69 @@
+import tensorflow as tf
+
+
+class AdaptiveSoftmax(object):
+    """Adaptive softmax (https://arxiv.org/abs/1609.04309) over a frequency-sorted vocabulary.
+
+    The head scores the cutoffs[0] most frequent words plus one entry per tail
+    cluster; tail cluster i covers ids [cutoffs[i], cutoffs[i + 1]) and first
+    projects its input down to input_size // factor ** (i + 1) dimensions, so
+    rare words cost a fraction of a full-width projection.
+
+    Args:
+      input_size: size of the vectors being classified.
+      cutoffs: increasing cluster boundaries; the last one is the vocabulary size.
+      factor: dimension reduction factor between consecutive clusters.
+      initializer: initializer for the projection matrices.
+      dtype: the data type of the variables.
+      scope: VariableScope for the variables; defaults to "adaptive_softmax".
+    """
+
+    def __init__(self, input_size, cutoffs, factor=4, initializer=None, dtype=tf.float32, scope=None):
+        if list(cutoffs) != sorted(set(cutoffs)) or len(cutoffs) < 2:
+            raise ValueError("cutoffs must be at least two strictly increasing ids, got %s." % (cutoffs,))
+        self.cutoffs = list(cutoffs)
+        self.head_size = self.cutoffs[0] + len(self.cutoffs) - 1
+        with tf.variable_scope(scope or "adaptive_softmax"):
+            self.head_w = tf.get_variable("head_w", [input_size, self.head_size], dtype=dtype,
+                                          initializer=initializer)
+            self.head_b = tf.get_variable("head_b", [self.head_size], dtype=dtype,
+                                          initializer=tf.zeros_initializer())
+            self.tails = []
+            for i in range(len(self.cutoffs) - 1):
+                dim = max(1, input_size // factor ** (i + 1))
+                cluster_size = self.cutoffs[i + 1] - self.cutoffs[i]
+                proj = tf.get_variable("tail%d_proj" % i, [input_size, dim], dtype=dtype, initializer=initializer)
+                w = tf.get_variable("tail%d_w" % i, [dim, cluster_size], dtype=dtype, initializer=initializer)
+                b = tf.get_variable("tail%d_b" % i, [cluster_size], dtype=dtype,
+                                    initializer=tf.zeros_initializer())
+                self.tails.append((proj, w, b))
+
+    def loss(self, inputs, labels):
+        """Per-example negative log-likelihood; usable as a softmax_loss_function.
+
+        Each tail cluster is only evaluated on the rows whose label falls in it.
+        """
+        labels = tf.reshape(tf.cast(labels, tf.int32), [-1])
+        head_labels = labels
+        tail_loss = tf.zeros(tf.shape(labels), dtype=inputs.dtype)
+        for i, (proj, w, b) in enumerate(self.tails):
+            low, high = self.cutoffs[i], self.cutoffs[i + 1]
+            in_cluster = tf.logical_and(labels >= low, labels < high)
+            head_labels = tf.where(in_cluster, tf.fill(tf.shape(labels), self.cutoffs[0] + i), head_labels)
+            rows = tf.where(in_cluster)
+            tail_logits = tf.matmul(tf.matmul(tf.gather_nd(inputs, rows), proj), w) + b
+            tail_xent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=tf.gather_nd(labels, rows) - low, logits=tail_logits)
+            tail_loss += tf.scatter_nd(rows, tail_xent, tf.shape(labels, out_type=tf.int64))
+        head_logits = tf.matmul(inputs, self.head_w) + self.head_b
+        head_xent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=head_labels, logits=head_logits)
+        return head_xent + tail_loss
+
+    def log_probs(self, inputs):
+        """Full [batch_size x vocabulary_size] log-probabilities, usable as logits."""
+        head = tf.nn.log_softmax(tf.matmul(inputs, self.head_w) + self.head_b)
+        parts = [head[:, :self.cutoffs[0]]]
+        for i, (proj, w, b) in enumerate(self.tails):
+            tail = tf.nn.log_softmax(tf.matmul(tf.matmul(inputs, proj), w) + b)
+            parts.append(tail + head[:, self.cutoffs[0] + i:self.cutoffs[0] + i + 1])
+        return tf.concat(axis=1, values=parts)
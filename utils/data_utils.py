@@ -15,13 +15,23 @@
 
 """Utilities for downloading data from WMT, tokenizing, vocabularies."""
 
+import collections
+import contextlib
 import gzip
+import heapq
+import io
 import os
 import re
+import shutil
 from urllib.request import urlretrieve
 
 from tensorflow.python.platform import gfile
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Special vocabulary symbols - we always put them at the start.
 _PAD = "_PAD"
 _GO = "_GO"
@@ -38,11 +48,35 @@ UNK_ID = 3
 _WORD_SPLIT = re.compile("([.,!?\"':;)(])")
 _DIGIT_RE = re.compile(r"\d")
 
+# Byte-pair encoding markers: _BPE_END closes the last symbol of a word while
+# merges are learned and applied, _BPE_CONTINUATION ends every subword token
+# that is not the end of a word ("lower" -> "low@@ er").
+_BPE_END = "</w>"
+_BPE_CONTINUATION = "@@"
+
+# Compressed corpora are read through a decompressing stream.
+_COMPRESSED_SUFFIXES = (".gz", ".zst", ".zstd")
+# Files written next to corpus shards, which a shard glob must not pick up.
+_DERIVED_FILE_RE = re.compile(r"\.ids\d+|\.tmp$")
+
 # URLs for WMT data.
 _WMT_ENFR_TRAIN_URL = "http://www.statmt.org/wmt10/training-giga-fren.tar"
 _WMT_ENFR_DEV_URL = "http://www.statmt.org/wmt15/dev-v2.tgz"
 
 
+@contextlib.contextmanager
+def _atomic_write(path, mode="w"):
+    """Open path for writing through a temporary file that is renamed into place on success.
+
+    Distributed workers may prepare the same data_dir at once; this way none
+    of them reads a file another one is still writing.
+    """
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with gfile.GFile(tmp_path, mode=mode) as f:
+        yield f
+    gfile.Rename(tmp_path, path, overwrite=True)
+
+
 def maybe_download(directory, filename, url):
     """Download filename from url unless it's already in directory."""
     if not os.path.exists(directory):
@@ -60,10 +94,59 @@ def maybe_download(directory, filename, url):
 def gunzip_file(gz_path, new_path):
     """Unzips from gz_path into new_path."""
     print("Unpacking %s to %s" % (gz_path, new_path))
-    with gzip.open(gz_path, "r") as gz_file:
-        with open(new_path, "w") as new_file:
-            for line in gz_file:
-                new_file.write(line)
+    with gzip.open(gz_path, "rb") as gz_file:
+        with open(new_path, "wb") as new_file:
+            shutil.copyfileobj(gz_file, new_file)
+
+
+def open_corpus(path):
+    """Open a one-sentence-per-line corpus for reading as text.
+
+    Files ending in .gz, and in .zst or .zstd if the zstandard package is
+    installed, are decompressed on the fly while they are read.
+
+    Raises:
+      ValueError: if path is zstd-compressed and zstandard is not installed.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode="rt", encoding="utf-8")
+    if path.endswith((".zst", ".zstd")):
+        if zstandard is None:
+            raise ValueError("Reading %s requires the zstandard package." % path)
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return gfile.GFile(path, mode="r")
+
+
+def corpus_lines(data_path):
+    """Lines of a corpus file, or of a list of corpus files in order."""
+    data_paths = [data_path] if isinstance(data_path, str) else data_path
+    for path in data_paths:
+        with open_corpus(path) as f:
+            for line in f:
+                yield line
+
+
+def corpus_shards(data_dir, pattern):
+    """Sorted corpus shards in data_dir matching the glob pattern, without derived files."""
+    return sorted(path for path in gfile.Glob(os.path.join(data_dir, pattern))
+                  if not _DERIVED_FILE_RE.search(os.path.basename(path)))
+
+
+def _strip_compression(path):
+    for suffix in _COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def corpus_path(data_dir, name):
+    """Path of corpus name in data_dir: name itself, or else a compressed name.gz, name.zst, ..."""
+    for suffix in ("",) + _COMPRESSED_SUFFIXES:
+        path = os.path.join(data_dir, name + suffix)
+        if gfile.Exists(path):
+            return path
+    return os.path.join(data_dir, name)
 
 
 def basic_tokenizer(sentence):
@@ -83,10 +166,15 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, embedding
     Vocabulary contains the most-frequent tokens up to max_vocabulary_size.
     We write it to vocabulary_path in a one-token-per-line format, so that later
     token in the first line gets id=0, second line gets id=1, and so on.
+    The corresponding token counts are written one-per-line to
+    vocabulary_path + ".counts" (see counts_path); _UNK is credited with the
+    counts of all words cut off by max_vocabulary_size and _EOS with one count
+    per sentence. Counts are at least 1, see save_counts.
 
     Args:
       vocabulary_path: path where the vocabulary will be created.
-      data_path: data file that will be used to create vocabulary.
+      data_path: data file, or list of data files, that will be used to create
+        vocabulary; they may be compressed, see open_corpus.
       max_vocabulary_size: limit on the size of the created vocabulary.
       tokenizer: a function to use to tokenize each data sentence;
         if None, basic_tokenizer will be used.
@@ -96,27 +184,248 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size, embedding
         print("Creating vocabulary %s from data %s" % (vocabulary_path, data_path))
         print("Creating embedding file %s from data %s" % (embedding_path, data_path))
         vocab = {}
-        with gfile.GFile(data_path, mode="r") as f:
-            counter = 0
-            for line in f:
-                counter += 1
-                if counter % 100000 == 0:
-                    print("  processing line %d" % counter)
-                tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-                for w in tokens:
-                    word = _DIGIT_RE.sub("0", w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
-            vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-            if len(vocab_list) > max_vocabulary_size:
-                vocab_list = vocab_list[:max_vocabulary_size]
-            with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-                with gfile.GFile(embedding_path, mode="wb") as embedding_file:
-                    for w in vocab_list:
-                        vocab_file.write(w + "\n")
-                        embedding_file.write(w + "\n")
+        counter = 0
+        for line in corpus_lines(data_path):
+            counter += 1
+            if counter % 100000 == 0:
+                print("  processing line %d" % counter)
+            tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
+            for w in tokens:
+                word = _DIGIT_RE.sub("0", w) if normalize_digits else w
+                if word in vocab:
+                    vocab[word] += 1
+                else:
+                    vocab[word] = 1
+        vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
+        if len(vocab_list) > max_vocabulary_size:
+            vocab_list = vocab_list[:max_vocabulary_size]
+        counts = [vocab.get(w, 0) for w in vocab_list]
+        counts[EOS_ID] = counter
+        counts[UNK_ID] = sum(vocab.values()) - sum(counts[len(_START_VOCAB):])
+        save_counts(counts_path(vocabulary_path), counts)
+        # The vocabulary comes last, so that whoever finds it also finds the rest.
+        for path in (embedding_path, vocabulary_path):
+            with _atomic_write(path, mode="wb") as f:
+                for w in vocab_list:
+                    f.write(w + "\n")
+
+
+def counts_path(vocabulary_path):
+    """Path of the token counts file stored alongside vocabulary_path."""
+    return vocabulary_path + ".counts"
+
+
+def save_counts(path, counts):
+    """Write token counts one-per-line, in vocabulary id order.
+
+    Counts are floored at 1: with the unigram candidate sampler, sampled
+    softmax subtracts the log of each label's expected count, which is -inf
+    for a count of 0, and _PAD, which never occurs in the data, is the label
+    of every padded target position.
+    """
+    with _atomic_write(path) as counts_file:
+        for count in counts:
+            counts_file.write("%d\n" % max(count, 1))
+
+
+def load_counts(path, vocabulary_size):
+    """Read token counts written by save_counts, floored at 1 and padded with 1s to vocabulary_size.
+
+    Raises:
+      ValueError: if the provided path does not exist.
+    """
+    if not gfile.Exists(path):
+        raise ValueError("Token counts file %s not found." % path)
+    with gfile.GFile(path, mode="r") as counts_file:
+        counts = [int(line) for line in counts_file]
+    counts = [max(count, 1) for count in counts[:vocabulary_size]]
+    return counts + [1] * (vocabulary_size - len(counts))
+
+
+def create_counts_from_token_ids(counts_path, token_ids_path, vocabulary_size):
+    """Create the counts file (if it does not exist yet) from a token-ids file, or a list of them.
+
+    This backfills counts for vocabularies created before counts were saved.
+    """
+    if not gfile.Exists(counts_path):
+        print("Counting tokens in %s" % (token_ids_path,))
+        counts = [0] * vocabulary_size
+        for line in corpus_lines(token_ids_path):
+            for tok in line.split():
+                counts[int(tok)] += 1
+            counts[EOS_ID] += 1
+        save_counts(counts_path, counts)
+
+
+def vocabulary_path(data_dir, vocabulary_size, bpe_merges=0):
+    """Path of the vocabulary for the given size and number of BPE merges."""
+    if bpe_merges:
+        return os.path.join(data_dir, "vocab%d.bpe%d" % (vocabulary_size, bpe_merges))
+    return os.path.join(data_dir, "vocab%d" % vocabulary_size)
+
+
+def bpe_codes_path(data_dir, bpe_merges):
+    """Path of the BPE merge table learned with bpe_merges merges."""
+    return os.path.join(data_dir, "bpe%d.codes" % bpe_merges)
+
+
+def _bpe_symbols(word):
+    return tuple(word[:-1]) + (word[-1] + _BPE_END,)
+
+
+def _bpe_merge(symbols, pair):
+    merged = []
+    i = 0
+    while i < len(symbols):
+        if i < len(symbols) - 1 and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            merged.append(symbols[i] + symbols[i + 1])
+            i += 2
+        else:
+            merged.append(symbols[i])
+            i += 1
+    return tuple(merged)
+
+
+def learn_bpe(data_path, num_merges, tokenizer=None, normalize_digits=True, min_frequency=2):
+    """Learn byte-pair encoding merges (https://arxiv.org/abs/1508.07909).
+
+    Words are split into characters and the most frequent pair of adjacent
+    symbols is merged repeatedly. Pair counts are updated incrementally for
+    the words that contain the merged pair, and the most frequent pair is
+    found through a lazily invalidated heap.
+
+    Args:
+      data_path: data file, or list of data files, in one-sentence-per-line
+        format, possibly compressed.
+      num_merges: maximum number of merges to learn.
+      tokenizer: a function to use to split each sentence into words;
+        if None, basic_tokenizer will be used.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      min_frequency: stop once the most frequent pair occurs less often.
+
+    Returns:
+      the list of merged symbol pairs, in the order they were learned.
+    """
+    word_counts = collections.Counter()
+    for line in corpus_lines(data_path):
+        for w in (tokenizer(line) if tokenizer else basic_tokenizer(line)):
+            word_counts[_DIGIT_RE.sub("0", w) if normalize_digits else w] += 1
+
+    words = [_bpe_symbols(w) for w in word_counts]
+    freqs = list(word_counts.values())
+    stats = collections.defaultdict(int)
+    where = collections.defaultdict(set)
+    for i, symbols in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            stats[pair] += freqs[i]
+            where[pair].add(i)
+    heap = [(-count, pair) for pair, count in stats.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_merges:
+        count, best = heapq.heappop(heap)
+        if -count != stats.get(best, 0):
+            continue  # Stale entry; the pair's current count was pushed later.
+        if -count < min_frequency:
+            break
+        merges.append(best)
+        changed = set()
+        for i in where.pop(best):
+            symbols = words[i]
+            merged = _bpe_merge(symbols, best)
+            if merged == symbols:
+                continue
+            for pair in zip(symbols, symbols[1:]):
+                stats[pair] -= freqs[i]
+                changed.add(pair)
+            for pair in zip(merged, merged[1:]):
+                stats[pair] += freqs[i]
+                where[pair].add(i)
+                changed.add(pair)
+            words[i] = merged
+        stats.pop(best, None)
+        changed.discard(best)
+        for pair in changed:
+            if stats[pair] > 0:
+                heapq.heappush(heap, (-stats[pair], pair))
+            else:
+                del stats[pair]
+    return merges
+
+
+def create_bpe_codes(codes_path, data_path, num_merges, tokenizer=None, normalize_digits=True):
+    """Learn BPE merges from data file and save them (if not done yet), one pair per line."""
+    if not gfile.Exists(codes_path):
+        print("Learning %d BPE merges from data %s" % (num_merges, data_path))
+        merges = learn_bpe(data_path, num_merges, tokenizer, normalize_digits)
+        with _atomic_write(codes_path) as codes_file:
+            for pair in merges:
+                codes_file.write("%s %s\n" % pair)
+
+
+class BPETokenizer(object):
+    """Splits sentences into subword tokens with a learned BPE merge table.
+
+    Instances are tokenizers in the sense of create_vocabulary,
+    sentence_to_token_ids and data_to_token_ids. Each word is segmented by
+    repeatedly applying the earliest-learned merge among its adjacent symbol
+    pairs, and segmentations are memoized per word.
+
+    Args:
+      codes_path: merge table written by create_bpe_codes.
+      tokenizer: a function to use to split each sentence into words;
+        if None, basic_tokenizer will be used.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+
+    Raises:
+      ValueError: if the provided codes_path does not exist.
+    """
+
+    def __init__(self, codes_path, tokenizer=None, normalize_digits=True):
+        if not gfile.Exists(codes_path):
+            raise ValueError("BPE codes file %s not found." % codes_path)
+        with gfile.GFile(codes_path, mode="r") as codes_file:
+            self.ranks = dict((tuple(line.split()), rank) for rank, line in enumerate(codes_file))
+        self.tokenizer = tokenizer or basic_tokenizer
+        self.normalize_digits = normalize_digits
+        self.cache = {}
+
+    def encode_word(self, word):
+        """Subword tokens of a single word, e.g. "lower" -> ["low@@", "er"]."""
+        if word in self.cache:
+            return self.cache[word]
+        symbols = _bpe_symbols(word)
+        while len(symbols) > 1:
+            pairs = set(zip(symbols, symbols[1:]))
+            best = min(pairs, key=lambda pair: self.ranks.get(pair, float("inf")))
+            if best not in self.ranks:
+                break
+            symbols = _bpe_merge(symbols, best)
+        tokens = [s + _BPE_CONTINUATION for s in symbols[:-1]] + [symbols[-1][:-len(_BPE_END)]]
+        self.cache[word] = tokens
+        return tokens
+
+    def __call__(self, sentence):
+        tokens = []
+        for w in self.tokenizer(sentence):
+            tokens.extend(self.encode_word(_DIGIT_RE.sub("0", w) if self.normalize_digits else w))
+        return tokens
+
+
+def bpe_detokenize(tokens):
+    """Join subword tokens produced by BPETokenizer back into words."""
+    sentence = " ".join(tokens).replace(_BPE_CONTINUATION + " ", "")
+    if sentence.endswith(_BPE_CONTINUATION):
+        sentence = sentence[:-len(_BPE_CONTINUATION)]
+    return sentence
+
+
+def get_tokenizer(data_dir, bpe_merges=0):
+    """The BPETokenizer for bpe_merges merges, or None (basic_tokenizer) if 0."""
+    if bpe_merges:
+        return BPETokenizer(bpe_codes_path(data_dir, bpe_merges))
+    return None
 
 
 def initialize_vocabulary(vocabulary_path):
@@ -187,7 +496,8 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
     for sentence_to_token_ids on the details of token-ids format.
 
     Args:
-      data_path: path to the data file in one-sentence-per-line format.
+      data_path: path to the data file in one-sentence-per-line format,
+        possibly compressed (see open_corpus).
       target_path: path where the file with token-ids will be created.
       vocabulary_path: path to the vocabulary file.
       tokenizer: a function to use to tokenize each sentence;
@@ -197,8 +507,8 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
     if not gfile.Exists(target_path):
         print("Tokenizing data in %s" % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
-        with gfile.GFile(data_path, mode="r") as data_file:
-            with gfile.GFile(target_path, mode="w") as tokens_file:
+        with open_corpus(data_path) as data_file:
+            with _atomic_write(target_path) as tokens_file:
                 counter = 0
                 for line in data_file:
                     counter += 1
@@ -209,23 +519,79 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
                     tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
 
 
-def prepare_wmt_data(data_dir, vocabulary_size, tokenizer=None):
+def prepare_wmt_data(data_dir, vocabulary_size, tokenizer=None, bpe_merges=0, train_glob=None):
+    """Tokenize the corpora in data_dir into token-id files, creating the vocabulary first.
+
+    The training corpus is train.txt or, if train_glob is given, every shard
+    in data_dir matching it. Each shard gets its own token-ids file against
+    the vocabulary (and BPE merges), which are built from the shards present
+    when they are first created and frozen afterwards; shards added later are
+    tokenized on the next call without reprocessing the others.
+
+    Returns:
+      a triple (train_ids, dev_ids_path, vocab_path), where train_ids is the
+      token-ids path of train.txt, or the list of those of the shards.
+    """
     # Get wmt data to the specified directory.
-    train_path = os.path.join(data_dir, "train.txt")
-    dev_path = os.path.join(data_dir, "dev.txt")
+    # Either corpus may be compressed, see open_corpus.
+    if train_glob:
+        train_path = corpus_shards(data_dir, train_glob)
+        if not train_path:
+            raise ValueError("No corpus shards match %s in %s." % (train_glob, data_dir))
+    else:
+        train_path = corpus_path(data_dir, "train.txt")
+    dev_path = corpus_path(data_dir, "dev.txt")
+    ids_suffix = _ids_suffix(vocabulary_size, bpe_merges)
+    embedding_path = os.path.join(data_dir, "embedding{0}.tsv".format(vocabulary_size))
+
+    # Learn subword units on the training data and tokenize into them.
+    if bpe_merges:
+        codes_path = bpe_codes_path(data_dir, bpe_merges)
+        create_bpe_codes(codes_path, train_path, bpe_merges, tokenizer)
+        tokenizer = BPETokenizer(codes_path, tokenizer)
+        embedding_path = os.path.join(data_dir, "embedding{0}.bpe{1}.tsv".format(vocabulary_size, bpe_merges))
 
     # Create vocabularies of the appropriate sizes.
-    vocab_path = os.path.join(data_dir, "vocab%d" % vocabulary_size)
-    create_vocabulary(vocab_path, train_path, vocabulary_size,
-                      os.path.join(data_dir, "embedding{0}.tsv".format(vocabulary_size)),
-                      tokenizer)
+    vocab_path = vocabulary_path(data_dir, vocabulary_size, bpe_merges)
+    create_vocabulary(vocab_path, train_path, vocabulary_size, embedding_path, tokenizer)
 
     # Create token ids for the training data.
-    train_ids_path = train_path + (".ids%d" % vocabulary_size)
-    data_to_token_ids(train_path, train_ids_path, vocab_path, tokenizer)
+    if train_glob:
+        train_ids_path = []
+        for shard_path in train_path:
+            train_ids_path.append(_strip_compression(shard_path) + ids_suffix)
+            data_to_token_ids(shard_path, train_ids_path[-1], vocab_path, tokenizer)
+    else:
+        train_ids_path = os.path.join(data_dir, "train.txt") + ids_suffix
+        data_to_token_ids(train_path, train_ids_path, vocab_path, tokenizer)
+    create_counts_from_token_ids(counts_path(vocab_path), train_ids_path, vocabulary_size)
 
     # Create token ids for the development data.
-    dev_ids_path = dev_path + (".ids%d" % vocabulary_size)
+    dev_ids_path = os.path.join(data_dir, "dev.txt") + ids_suffix
     data_to_token_ids(dev_path, dev_ids_path, vocab_path, tokenizer)
 
     return (train_ids_path, dev_ids_path, vocab_path)
+
+
+def prepare_eval_data(data_dir, name, vocabulary_size, bpe_merges=0):
+    """Tokenize corpus name in data_dir with the vocabulary prepare_wmt_data created.
+
+    Returns:
+      the path of the token-ids file.
+
+    Raises:
+      ValueError: if the corpus does not exist, neither plain nor compressed.
+    """
+    path = corpus_path(data_dir, name)
+    if not gfile.Exists(path):
+        raise ValueError("Corpus %s not found in %s." % (name, data_dir))
+    ids_path = os.path.join(data_dir, name) + _ids_suffix(vocabulary_size, bpe_merges)
+    data_to_token_ids(path, ids_path, vocabulary_path(data_dir, vocabulary_size, bpe_merges),
+                      get_tokenizer(data_dir, bpe_merges))
+    return ids_path
+
+
+def _ids_suffix(vocabulary_size, bpe_merges):
+    if bpe_merges:
+        return ".ids%d.bpe%d" % (vocabulary_size, bpe_merges)
+    return ".ids%d" % vocabulary_size
@@ -41,8 +41,9 @@ def repeat(x, n):
     if n == 1:
         return x
 
-    shape = map(int, x.get_shape().as_list())
-    shape[0] *= n
+    shape = x.get_shape().as_list()
+    if shape[0] is not None:
+        shape[0] *= n
     idx = tf.range(tf.shape(x)[0])
     idx = tf.reshape(idx, [-1, 1])
     idx = tf.tile(idx, [1, n])
@@ -0,0 +1,85 @@
+import random
+
+import numpy as np
+
+
+class EpochSampler(object):
+    """Draws training batches epoch by epoch in an order fixed by a seed.
+
+    Every epoch shuffles the examples of each bucket, cuts them into batches
+    (the last batch of a bucket wraps around to its start) and shuffles the
+    batches of all buckets together, so buckets are visited in proportion to
+    their size and every example is seen once per epoch. The order of an epoch
+    only depends on (seed, epoch), so (seed, epoch, cursor) pins down the data
+    position exactly, as long as the training data stays the same.
+
+    Args:
+      bucket_sizes: number of examples in each bucket.
+      batch_size: number of examples per batch.
+      seed: shuffle seed.
+      epoch: epoch to start in.
+      cursor: number of batches of that epoch already drawn.
+      shards: the training data files, saved with the state to tell whether
+        a restored position still refers to the same data.
+    """
+
+    def __init__(self, bucket_sizes, batch_size, seed=0, epoch=0, cursor=0, shards=None):
+        if not sum(bucket_sizes):
+            raise ValueError("Cannot sample batches from empty buckets.")
+        self.bucket_sizes = list(bucket_sizes)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = epoch
+        self.cursor = cursor
+        self.shards = list(shards or [])
+        self._plan = None
+
+    def _plan_epoch(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        plan = []
+        for bucket_id, size in enumerate(self.bucket_sizes):
+            order = rng.permutation(size)
+            for start in range(0, size, self.batch_size):
+                plan.append((bucket_id, np.take(order, np.arange(start, start + self.batch_size), mode="wrap")))
+        rng.shuffle(plan)
+        return plan
+
+    def next_batch(self):
+        """The (bucket_id, example indices) of the next batch."""
+        if self._plan is None:
+            self._plan = self._plan_epoch()
+        if self.cursor >= len(self._plan):
+            self.epoch, self.cursor = self.epoch + 1, 0
+            self._plan = self._plan_epoch()
+        self.cursor += 1
+        return self._plan[self.cursor - 1]
+
+    def epochs(self):
+        """Number of epochs drawn so far, fractional within the current one."""
+        if self._plan is None:
+            self._plan = self._plan_epoch()
+        return self.epoch + self.cursor / float(len(self._plan))
+
+    def state(self):
+        """JSON-serializable data position and the Python and NumPy global RNG states."""
+        np_name, np_keys, np_pos, np_has_gauss, np_gauss = np.random.get_state()
+        return {"seed": self.seed, "epoch": self.epoch, "cursor": self.cursor,
+                "shards": self.shards, "bucket_sizes": self.bucket_sizes,
+                "python_rng": random.getstate(),
+                "numpy_rng": [np_name, np_keys.tolist(), np_pos, np_has_gauss, np_gauss]}
+
+    @classmethod
+    def restore(cls, state, bucket_sizes, batch_size, shards=None):
+        """A sampler at the position of state, with the global RNG states reset to it.
+
+        If the shards or bucket sizes differ from those of state, the saved
+        position no longer means anything and the sampler starts the next epoch.
+        """
+        version, internal, gauss_next = state["python_rng"]
+        random.setstate((version, tuple(internal), gauss_next))
+        np_name, np_keys, np_pos, np_has_gauss, np_gauss = state["numpy_rng"]
+        np.random.set_state((np_name, np.array(np_keys, dtype=np.uint32), np_pos, np_has_gauss, np_gauss))
+        epoch, cursor = state["epoch"], state["cursor"]
+        if state.get("shards") != list(shards or []) or state.get("bucket_sizes") != list(bucket_sizes):
+            epoch, cursor = epoch + 1, 0
+        return cls(bucket_sizes, batch_size, seed=state["seed"], epoch=epoch, cursor=cursor, shards=shards)
@@ -0,0 +1,56 @@
+"""Static size estimates for a TensorFlow graph, computed without running it."""
+
+import resource
+import sys
+
+import tensorflow as tf
+
+
+def variable_bytes(variables):
+    """Total bytes of the given variables."""
+    return sum(v.shape.num_elements() * v.dtype.base_dtype.size for v in variables)
+
+
+def tensor_bytes(tensor, batch_size):
+    """Bytes of tensor with every unknown dimension taken as batch_size.
+
+    Returns 0 for tensors of unknown rank and for tensors without an unknown
+    dimension, which are parameters or constants rather than activations.
+    """
+    if tensor.shape.ndims is None or tensor.shape.is_fully_defined():
+        return 0
+    num_elements = 1
+    for dim in tensor.shape.as_list():
+        num_elements *= batch_size if dim is None else dim
+    return num_elements * tensor.dtype.base_dtype.size
+
+
+def upstream_ops(fetches):
+    """All ops that fetches depend on, including control dependencies."""
+    seen = set()
+    stack = [fetch if isinstance(fetch, tf.Operation) else fetch.op for fetch in fetches]
+    while stack:
+        op = stack.pop()
+        if op in seen:
+            continue
+        seen.add(op)
+        stack.extend(tensor.op for tensor in op.inputs)
+        stack.extend(op.control_inputs)
+    return seen
+
+
+def activation_bytes(ops, batch_sizes):
+    """Estimated activation memory of running ops, for each batch size.
+
+    Sums every output with a batch dimension as if all were alive at once, so
+    this is an upper bound; TensorFlow frees most tensors once consumed.
+    """
+    outputs = [tensor for op in ops for tensor in op.outputs]
+    return [sum(tensor_bytes(tensor, batch_size) for tensor in outputs) for batch_size in batch_sizes]
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
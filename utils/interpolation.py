@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def lerp(start, end, num_pts):
+    """Linear interpolation between batches of points.
+
+    Args:
+      start: array of shape (num_pairs, dim).
+      end: array of shape (num_pairs, dim).
+      num_pts: number of points per pair, including both endpoints.
+
+    Returns:
+      array of shape (num_pairs, num_pts, dim).
+    """
+    start, end = np.asarray(start), np.asarray(end)
+    t = np.linspace(0.0, 1.0, num_pts, dtype=start.dtype)[None, :, None]
+    return start[:, None, :] * (1.0 - t) + end[:, None, :] * t
+
+
+def slerp(start, end, num_pts, eps=1e-6):
+    """Spherical linear interpolation between batches of points.
+
+    Follows the great circle between the directions of start and end, which
+    keeps intermediate points at a typical norm for a Gaussian prior instead
+    of cutting through the low-density region near the origin. Pairs with
+    (anti)parallel directions fall back to lerp.
+
+    Args:
+      start: array of shape (num_pairs, dim).
+      end: array of shape (num_pairs, dim).
+      num_pts: number of points per pair, including both endpoints.
+
+    Returns:
+      array of shape (num_pairs, num_pts, dim).
+    """
+    start, end = np.asarray(start), np.asarray(end)
+    t = np.linspace(0.0, 1.0, num_pts, dtype=start.dtype)[None, :]
+    norms = np.linalg.norm(start, axis=1) * np.linalg.norm(end, axis=1)
+    cos_omega = np.sum(start * end, axis=1) / np.maximum(norms, eps)
+    omega = np.arccos(np.clip(cos_omega, -1.0, 1.0))[:, None]
+    sin_omega = np.sin(omega)
+    parallel = np.abs(sin_omega) < eps
+    sin_omega[parallel] = 1.0
+    start_weight = np.where(parallel, 1.0 - t, np.sin((1.0 - t) * omega) / sin_omega)
+    end_weight = np.where(parallel, t, np.sin(t * omega) / sin_omega)
+    return start[:, None, :] * start_weight[:, :, None] + end[:, None, :] * end_weight[:, :, None]
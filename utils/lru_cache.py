@@ -0,0 +1,71 @@
+import collections
+import time
+
+
+class LRUCache(object):
+    """Least-recently-used cache with an optional time-to-live, scoped to one checkpoint.
+
+    Entries are only valid for the model parameters they were computed with:
+    set_checkpoint drops all of them when the checkpoint id changes.
+
+    Args:
+      max_size: maximum number of entries; the least recently used entry is
+        evicted beyond that.
+      ttl: seconds after which an entry expires (0: never).
+      clock: function returning the current time in seconds.
+    """
+
+    def __init__(self, max_size, ttl=0, clock=time.time):
+        if max_size < 1:
+            raise ValueError("max_size must be positive, got %d." % max_size)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.checkpoint_id = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def set_checkpoint(self, checkpoint_id):
+        """Drop all entries if they were computed with another checkpoint."""
+        if checkpoint_id != self.checkpoint_id:
+            if self.entries:
+                self.invalidations += 1
+                self.entries.clear()
+            self.checkpoint_id = checkpoint_id
+
+    def get(self, key):
+        """The value cached for key, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, stored_at = entry
+        if self.ttl and self.clock() - stored_at > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (value, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return ("cache: %d entries, %d hits, %d misses (hit rate %.1f%%), %d evictions, "
+                "%d expirations, %d invalidations" % (
+                    len(self.entries), self.hits, self.misses, 100.0 * self.hit_rate(),
+                    self.evictions, self.expirations, self.invalidations))
@@ -0,0 +1,170 @@
+"""Lightweight per-phase wall-clock profiler for training and inference loops.
+
+Phases are timed with `StepProfiler.phase(name)`; every timed interval is kept
+as a Chrome trace event, and for sampled steps the TensorFlow `RunMetadata`
+step stats are merged into the same trace. A disabled profiler costs a single
+attribute check per phase, so it can be threaded through unconditionally.
+Memory stays bounded on long runs: percentiles come from a fixed-size
+reservoir sample per phase, and trace events are appended to the trace file
+and dropped on every `write_trace`.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+
+
+class StepProfiler(object):
+    """Times named phases of a step loop and exports them.
+
+    Args:
+      enabled: if False, every method is a no-op.
+      trace_path: where `write_trace` dumps the Chrome trace JSON; None disables
+        trace export (percentile summaries are still collected).
+      trace_every: capture TensorFlow `RunMetadata` with FULL_TRACE every
+        `trace_every` steps (0 disables).
+      summary_every: print a percentile summary every `summary_every` steps
+        (0 disables).
+      max_events: cap on phase events written to the trace so its size stays
+        bounded.
+      reservoir_size: number of durations per phase kept for percentiles.
+    """
+
+    def __init__(self, enabled=False, trace_path=None, trace_every=0,
+                 summary_every=100, max_events=1000000, reservoir_size=10000):
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.trace_every = trace_every
+        self.summary_every = summary_every
+        self.max_events = max_events
+        self.reservoir_size = reservoir_size
+        # Per phase: [count, total seconds, max seconds, reservoir of durations].
+        self.durations = {}
+        self.events = []
+        self.tf_traces = []
+        self.steps = 0
+        self._origin = time.time()
+        self._pending_metadata = None
+        self._num_events = 0
+        self._num_tf_traces = 0
+        self._trace_started = False
+        # Private so that sampling never moves the global random state.
+        self._rng = random.Random(0)
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing one occurrence of phase `name`."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self._record(name, end - start)
+            if self.trace_path and self._num_events < self.max_events:
+                self._num_events += 1
+                self.events.append({"name": name, "ph": "X", "cat": "phase",
+                                    "ts": (start - self._origin) * 1e6,
+                                    "dur": (end - start) * 1e6,
+                                    "pid": os.getpid(),
+                                    "tid": threading.current_thread().ident})
+
+    def _record(self, name, duration):
+        stats = self.durations.get(name)
+        if stats is None:
+            stats = self.durations[name] = [0, 0.0, 0.0, []]
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        reservoir = stats[3]
+        if len(reservoir) < self.reservoir_size:
+            reservoir.append(duration)
+        else:
+            # Algorithm R: every duration so far is in the reservoir with equal probability.
+            k = self._rng.randrange(stats[0])
+            if k < self.reservoir_size:
+                reservoir[k] = duration
+
+    def run_kwargs(self):
+        """Keyword arguments for `session.run` on the current step.
+
+        Returns a dict with `options` and `run_metadata` when this step is
+        sampled for a TensorFlow trace, otherwise an empty dict.
+        """
+        if not self.enabled or not self.trace_every or self.steps % self.trace_every != 0:
+            return {}
+        self._pending_metadata = tf.RunMetadata()
+        return {"options": tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                "run_metadata": self._pending_metadata}
+
+    def step_end(self):
+        """Marks the end of a step; collects metadata and prints summaries."""
+        if not self.enabled:
+            return
+        if self._pending_metadata is not None:
+            self._add_run_metadata(self._pending_metadata)
+            self._pending_metadata = None
+        self.steps += 1
+        if self.summary_every and self.steps % self.summary_every == 0:
+            print(self.summary())
+
+    def _add_run_metadata(self, run_metadata):
+        from tensorflow.python.client import timeline
+        trace = json.loads(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        events = trace.get("traceEvents", [])
+        # Step stats are in microseconds since the epoch; move them onto the
+        # timeline of the phase events, which starts at _origin.
+        for event in events:
+            if "ts" in event:
+                event["ts"] = event["ts"] - self._origin * 1e6
+        self.tf_traces.append((self.steps, events))
+
+    def summary(self):
+        """Returns a text table of per-phase count, total share and percentiles."""
+        total = sum(stats[1] for stats in self.durations.values()) or 1e-12
+        lines = ["profile after %d steps:" % self.steps,
+                 "  %-16s %8s %7s %9s %9s %9s %9s" % ("phase", "count", "share",
+                                                      "p50 ms", "p90 ms", "p99 ms", "max ms")]
+        for name, (count, seconds, longest, reservoir) in sorted(self.durations.items(),
+                                                                  key=lambda kv: -kv[1][1]):
+            p50, p90, p99 = np.percentile(reservoir, [50, 90, 99]) * 1000
+            lines.append("  %-16s %8d %6.1f%% %9.2f %9.2f %9.2f %9.2f" % (
+                name, count, 100.0 * seconds / total, p50, p90, p99, longest * 1000))
+        return "\n".join(lines)
+
+    def write_trace(self):
+        """Appends the events collected since the last call to `trace_path`.
+
+        The file is in Chrome's JSON array trace format, whose closing bracket
+        is optional, so it can be loaded while it is still being appended to.
+        """
+        if not self.enabled or not self.trace_path:
+            return
+        events = self.events
+        # Each sampled TensorFlow step gets its own pid so devices don't overlap.
+        for step, tf_events in self.tf_traces:
+            self._num_tf_traces += 1
+            pid_offset = 1000 * self._num_tf_traces
+            for event in tf_events:
+                event = dict(event)
+                if "pid" in event:
+                    event["pid"] = pid_offset + int(event["pid"])
+                if event.get("ph") == "M" and event.get("name") == "process_name":
+                    event["args"] = {"name": "step %d: %s" % (step, event["args"]["name"])}
+                events.append(event)
+        with open(self.trace_path, "a" if self._trace_started else "w") as f:
+            if not self._trace_started:
+                f.write("[\n")
+            for event in events:
+                f.write(json.dumps(event) + ",\n")
+        self._trace_started = True
+        self.events, self.tf_traces = [], []
+        print("Appended %d events to profile trace %s" % (len(events), self.trace_path))
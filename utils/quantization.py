@@ -0,0 +1,20 @@
+import numpy as np
+
+
+def quantize_rows(w):
+    """Symmetric int8 quantization of a 2D matrix with one scale per row.
+
+    Returns the quantized values offset by 128 as uint8 (the layout quint8
+    kernels expect for a [-128, 127] range) and the float32 per-row scales, so
+    that w[i] ~= (q[i] - 128) * scales[i].
+    """
+    w = np.asarray(w, dtype=np.float32)
+    scales = np.abs(w).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    q = np.clip(np.rint(w / scales[:, None]), -127, 127)
+    return (q + 128).astype(np.uint8), scales.astype(np.float32)
+
+
+def dequantize_rows(q, scales):
+    """Inverse of quantize_rows."""
+    return (q.astype(np.float32) - 128.0) * scales[:, None]
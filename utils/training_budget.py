@@ -0,0 +1,43 @@
+class TrainingBudget(object):
+    """Decides when a training loop should stop and tracks the best dev loss.
+
+    Every limit is disabled when 0.
+
+    Args:
+      max_steps: stop once the global step reaches this.
+      max_time: stop after this many seconds of wall time in this run.
+      max_epochs: stop after this many passes over the training data.
+      patience: stop after this many evaluations without a new best dev loss.
+      best_loss: best dev loss of earlier runs, if resuming.
+      best_step: global step of best_loss.
+    """
+
+    def __init__(self, max_steps=0, max_time=0, max_epochs=0, patience=0, best_loss=None, best_step=None):
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.best_loss = best_loss
+        self.best_step = best_step
+        self.evals_since_best = 0
+
+    def record_eval(self, step, loss):
+        """Record a dev loss; returns True if it is a new best."""
+        if self.best_loss is None or loss < self.best_loss:
+            self.best_loss, self.best_step = loss, step
+            self.evals_since_best = 0
+            return True
+        self.evals_since_best += 1
+        return False
+
+    def exhausted(self, step, wall_time, epochs):
+        """The reason to stop, or None to keep training."""
+        if self.max_steps and step >= self.max_steps:
+            return "reached max_steps %d" % self.max_steps
+        if self.max_time and wall_time >= self.max_time:
+            return "reached max_time %ds" % self.max_time
+        if self.max_epochs and epochs >= self.max_epochs:
+            return "reached max_epochs %g" % self.max_epochs
+        if self.patience and self.evals_since_best >= self.patience:
+            return "no dev improvement in %d evaluations since step %d" % (self.patience, self.best_step)
+        return None
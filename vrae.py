@@ -31,10 +31,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 import json
 import logging
 import math
+import multiprocessing
 import os
+import queue
+import shutil
 import sys
 import time
 
@@ -45,6 +49,12 @@ from tensorflow.python.platform import gfile
 
 import seq2seq_model
 import utils.data_utils as data_utils
+from utils.interpolation import lerp, slerp
+from utils.epoch_sampler import EpochSampler
+from utils.graph_report import activation_bytes, peak_rss_bytes, upstream_ops, variable_bytes
+from utils.lru_cache import LRUCache
+from utils.profiler import StepProfiler
+from utils.training_budget import TrainingBudget
 
 tf.app.flags.DEFINE_string("model_dir", "models", "directory of the model.")
 tf.app.flags.DEFINE_boolean("new", True, "whether this is a new model or not.")
@@ -52,9 +62,26 @@ tf.app.flags.DEFINE_string("do", "train", "what to do. accepts train, interpolat
 tf.app.flags.DEFINE_string("input", None, "input filename for reconstruct sample, and interpolate.")
 tf.app.flags.DEFINE_string("output", None, "output filename for reconstruct sample, and interpolate.")
 tf.app.flags.DEFINE_string("model_name", "", "")
+tf.app.flags.DEFINE_string("job_name", "", "distributed training role: ps or worker; empty trains locally.")
+tf.app.flags.DEFINE_integer("task_index", 0, "index of this task within its job; worker 0 is the chief.")
+tf.app.flags.DEFINE_string("ps_hosts", "", "comma separated host:port list of parameter servers.")
+tf.app.flags.DEFINE_string("worker_hosts", "", "comma separated host:port list of workers.")
+tf.app.flags.DEFINE_boolean("profile", False, "time each phase of train, reconstruct and encode.")
+tf.app.flags.DEFINE_string("profile_trace", None,
+                           "Chrome trace output path; defaults to profile_<do>.json in model_dir.")
+tf.app.flags.DEFINE_integer("profile_trace_every", 0,
+                            "capture TensorFlow step stats every this many steps (0: never).")
+tf.app.flags.DEFINE_integer("profile_summary_every", 100, "print a profile summary every this many steps.")
 
 FLAGS = tf.app.flags.FLAGS
 
+# Slim checkpoint written by --do export, relative to model_dir.
+INFERENCE_CHECKPOINT = "inference.ckpt"
+BEST_CHECKPOINT = "best.ckpt"
+SAMPLER_SUFFIX = ".sampler.json"
+# Seconds a reconstruct_parallel worker waits for its group of cores before running unpinned.
+CORE_QUEUE_TIMEOUT = 30
+
 
 def prelu(x):
     with tf.variable_scope("prelu") as scope:
@@ -72,33 +99,46 @@ def read_data(path, config, max_size=None):
         (source, target) pairs read from the provided data files that fit
         into the n-th bucket, i.e., such that len(source) < config.buckets[n][0] and
         len(target) < config.buckets[n][1]; source and target are lists of token-ids.
+        path may also be a list of token-ids shards, read in order; max_size
+        then limits the total.
     """
     data_set = [[] for _ in config.buckets]
-    with tf.gfile.GFile(path, mode="r") as f:
-        nextLine = f.readline()
-        counter = 0
-        while nextLine and (not max_size or counter < max_size):
-            counter += 1
-            if counter % 100000 == 0:
-                print("  reading data line %d" % counter)
-                sys.stdout.flush()
-            source_ids = [int(x) for x in nextLine.split()]
-            target_ids = source_ids
-            target_ids.append(data_utils.EOS_ID)
-            for bucket_id, (source_size, target_size) in enumerate(config.buckets):
-                if len(source_ids) < source_size and len(target_ids) < target_size:
-                    data_set[bucket_id].append([source_ids, target_ids])
-                    break
-            nextLine = f.readline()
+    counter = 0
+    for nextLine in data_utils.corpus_lines(path):
+        if max_size and counter >= max_size:
+            break
+        counter += 1
+        if counter % 100000 == 0:
+            print("  reading data line %d" % counter)
+            sys.stdout.flush()
+        source_ids = [int(x) for x in nextLine.split()]
+        target_ids = source_ids
+        target_ids.append(data_utils.EOS_ID)
+        for bucket_id, (source_size, target_size) in enumerate(config.buckets):
+            if len(source_ids) < source_size and len(target_ids) < target_size:
+                data_set[bucket_id].append([source_ids, target_ids])
+                break
     return data_set
 
 
-def create_model(session, config, forward_only):
-    """Create translation model and initialize or load parameters in session."""
+def build_model(config, forward_only, num_replicas=0):
+    """Build the Seq2SeqModel graph described by config without touching a session.
+
+    num_replicas is the number of distributed workers; with config.sync_replicas
+    their gradients are aggregated synchronously before every update.
+    """
     dtype = tf.float32
     optimizer = None
     if not forward_only:
         optimizer = tf.train.RMSPropOptimizer(config.learning_rate)
+        if num_replicas and config.sync_replicas:
+            if len(config.buckets) > 1:
+                raise ValueError("sync_replicas supports a single bucket only; SyncReplicasOptimizer "
+                                 "can apply one set of gradients per graph, got %d buckets." % len(config.buckets))
+            optimizer = tf.train.SyncReplicasOptimizer(
+                optimizer,
+                replicas_to_aggregate=config.replicas_to_aggregate or num_replicas,
+                total_num_replicas=num_replicas)
     if config.activation == "elu":
         activation = tf.nn.elu
     elif config.activation == "prelu":
@@ -109,6 +149,13 @@ def create_model(session, config, forward_only):
     weight_initializer = tf.orthogonal_initializer if config.orthogonal_initializer else tf.uniform_unit_scaling_initializer
     bias_initializer = tf.zeros_initializer()
 
+    if config.candidate_sampler not in ("log_uniform", "unigram"):
+        raise ValueError("candidate_sampler is not one of the following: log_uniform or unigram.")
+    unigram_counts = None
+    if not forward_only and config.candidate_sampler == "unigram":
+        vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
+        unigram_counts = data_utils.load_counts(data_utils.counts_path(vocab_path), config.vocab_size)
+
     model = seq2seq_model.Seq2SeqModel(
         config.vocab_size,
         config.vocab_size,
@@ -122,7 +169,8 @@ def create_model(session, config, forward_only):
         config.kl_min,
         config.word_dropout_keep_prob,
         config.anneal,
-        config.use_lstm,
+        use_lstm=config.use_lstm,
+        num_samples=config.num_samples,
         optimizer=optimizer,
         activation=activation,
         forward_only=forward_only,
@@ -131,58 +179,253 @@ def create_model(session, config, forward_only):
         weight_initializer=weight_initializer,
         bias_initializer=bias_initializer,
         iaf=config.iaf,
+        num_towers=config.num_towers,
+        quantize_projection=config.quantize_projection,
+        shortlist_size=config.shortlist_size,
+        unigram_counts=unigram_counts,
+        unigram_distortion=config.unigram_distortion,
+        adaptive_cutoffs=config.adaptive_cutoffs,
+        adaptive_factor=config.adaptive_factor,
+        share_embeddings=config.share_embeddings,
+        # Most subword units have no pretrained vector, so they are learned.
+        train_embeddings=config.bpe_merges > 0,
+        iw_samples=config.iw_samples if forward_only else 0,
         dtype=dtype)
+    return model
+
+
+def create_distributed_model(config, cluster, server, vocab):
+    """Build the model with variables on the ps job and open this worker's session.
+
+    The chief (task 0) initializes or restores the variables, loading the
+    pretrained embeddings for vocab into fresh ones, and, with sync_replicas,
+    starts the queue runner that aggregates gradients; other workers wait
+    until the chief has done so.
+    """
+    num_workers = cluster.num_tasks("worker")
+    is_chief = FLAGS.task_index == 0
+    with tf.device(tf.train.replica_device_setter(
+            worker_device="/job:worker/task:%d" % FLAGS.task_index, cluster=cluster)):
+        model = build_model(config, False, num_replicas=num_workers)
+    if config.sync_replicas:
+        init_tokens_op = model.optimizer.get_init_tokens_op()
+        chief_queue_runner = model.optimizer.get_chief_queue_runner()
+        # As SyncReplicasOptimizer's session run hook does: every worker sets its
+        # local step to the (possibly restored) global step, otherwise its first
+        # gradients count as stale and are dropped.
+        local_init_op = model.optimizer.chief_init_op if is_chief else model.optimizer.local_step_init_op
+        ready_for_local_init_op = model.optimizer.ready_for_local_init_op
+    else:
+        local_init_op = tf.local_variables_initializer()
+        ready_for_local_init_op = tf.report_uninitialized_variables(tf.global_variables())
+
+    sess_config = session_config(config) or tf.ConfigProto()
+    sess_config.device_filters.extend(["/job:ps", "/job:worker/task:%d" % FLAGS.task_index])
+    session_manager = tf.train.SessionManager(
+        local_init_op=local_init_op,
+        ready_for_local_init_op=ready_for_local_init_op)
+    if is_chief:
+        print("Loading pretrained word embeddings.")
+        sess = session_manager.prepare_session(
+            server.target,
+            init_op=embedding_init_op(model),
+            init_feed_dict={model.embedding_input: load_embeddings(vocab, config)},
+            saver=model.saver,
+            checkpoint_dir=None if FLAGS.new else FLAGS.model_dir,
+            config=sess_config)
+        if config.sync_replicas:
+            sess.run(init_tokens_op)
+            chief_queue_runner.create_threads(sess, start=True, daemon=True)
+    else:
+        print("Worker %d: waiting for the chief to initialize the model." % FLAGS.task_index)
+        sess = session_manager.wait_for_session(server.target, config=sess_config)
+    return model, sess
+
+
+def embedding_init_op(model):
+    """Initialize all variables, the embeddings last from model.embedding_input.
+
+    The embeddings count as uninitialized until they are assigned, so
+    workers waiting for the chief to initialize the model do not start
+    training on embeddings that are not loaded yet.
+    """
+    embeddings = set([model.enc_embedding, model.dec_embedding])
+    others = [v for v in tf.global_variables() if v not in embeddings]
+    with tf.control_dependencies([tf.variables_initializer(others)]):
+        return tf.group(*model.embedding_init_ops)
+
+
+def session_config(config):
+    """Session threading for config; None keeps the TensorFlow defaults.
+
+    With data-parallel towers, the inter-op pool is sized so that every tower
+    gets tower_inter_op_threads threads of its own and the towers' sequential
+    RNN chains can run concurrently instead of queueing behind each other.
+    """
+    if config.num_towers <= 1 and not config.intra_op_threads:
+        return None
+    return tf.ConfigProto(inter_op_parallelism_threads=config.num_towers * config.tower_inter_op_threads,
+                          intra_op_parallelism_threads=config.intra_op_threads)
+
+
+def checkpoint_id(path):
+    """Identifies the parameters in checkpoint path, also across overwrites of the same path."""
+    return "%s@%f" % (path, tf.train.get_checkpoint_mtimes([path])[0])
+
+
+def create_cache(config, reconstruct=False):
+    """The LRU result cache configured by cache_size and cache_ttl, or None if disabled.
+
+    Raises:
+      ValueError: if the cache is for reconstruction and config samples from
+        the posterior, whose reconstructions cannot be cached.
+    """
+    if not config.cache_size:
+        return None
+    if reconstruct and config.probabilistic:
+        raise ValueError("cache_size requires probabilistic to be false for reconstruction, "
+                         "since sampled reconstructions differ from run to run.")
+    return LRUCache(config.cache_size, ttl=config.cache_ttl)
+
+
+def create_model(session, config, forward_only, vocab=None):
+    """Create translation model and initialize or load parameters in session.
+
+    Fresh parameters get the pretrained embeddings for vocab, if given.
+    """
+    model = build_model(config, forward_only)
     ckpt = tf.train.get_checkpoint_state(FLAGS.model_dir)
-    if not FLAGS.new and ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
+    inference_path = os.path.join(FLAGS.model_dir, INFERENCE_CHECKPOINT)
+    use_inference = forward_only and not FLAGS.new and tf.train.checkpoint_exists(inference_path)
+    if use_inference and ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
+        inference_mtime, ckpt_mtime = tf.train.get_checkpoint_mtimes([inference_path, ckpt.model_checkpoint_path])
+        if inference_mtime < ckpt_mtime:
+            print("Ignoring %s, it is older than %s; rerun --do export." % (inference_path, ckpt.model_checkpoint_path))
+            use_inference = False
+    if use_inference:
+        print("Reading inference parameters from %s" % inference_path)
+        model.restore_inference(session, inference_path)
+        model.checkpoint_id = checkpoint_id(inference_path)
+    elif not FLAGS.new and ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
         print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+        model.restore(session, ckpt.model_checkpoint_path)
+        model.checkpoint_id = checkpoint_id(ckpt.model_checkpoint_path)
     else:
         print("Created model with fresh parameters.")
-        session.run(tf.global_variables_initializer())
+        if vocab is None:
+            session.run(tf.global_variables_initializer())
+        else:
+            print("Loading pretrained word embeddings.")
+            session.run(embedding_init_op(model), {model.embedding_input: load_embeddings(vocab, config)})
+    if model.quantized:
+        print("Quantizing the output projection to int8.")
+        model.quantize(session)
     return model
 
 
+def export_inference(config):
+    """Write the slim inference checkpoint from the latest training checkpoint."""
+    ckpt = tf.train.get_checkpoint_state(FLAGS.model_dir)
+    if not ckpt or not tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
+        raise ValueError("No checkpoint to export in %s." % FLAGS.model_dir)
+    with tf.Session() as sess:
+        model = build_model(config, True)
+        print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
+        model.restore(sess, ckpt.model_checkpoint_path)
+        path = model.export_inference(sess, os.path.join(FLAGS.model_dir, INFERENCE_CHECKPOINT),
+                                      float16=config.float16)
+    print("Wrote %s inference checkpoint %s" % ("float16" if config.float16 else "float32", path))
+
+
+def create_profiler():
+    """Create the step profiler configured by the --profile* flags."""
+    trace_path = FLAGS.profile_trace or os.path.join(FLAGS.model_dir, "profile_%s.json" % FLAGS.do)
+    return StepProfiler(enabled=FLAGS.profile,
+                        trace_path=trace_path,
+                        trace_every=FLAGS.profile_trace_every,
+                        summary_every=FLAGS.profile_summary_every)
+
+
 def load_embeddings(word_index, config):
+    """Build the float32 [vocab_size x size] matrix of pretrained embeddings for word_index.
+
+    The matrix is cached as .npy next to the vocabulary and memory-mapped on
+    later runs instead of parsing embeddings_path again. Words without a
+    pretrained vector get all-zero rows, or with bpe_merges, where most
+    subword units have none and the embeddings are trained, random rows
+    scaled like the pretrained vectors.
+    """
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
+    embeddings_name = os.path.splitext(os.path.basename(config.embeddings_path))[0]
+    cache_path = "%s.%s%s.npy" % (vocab_path, embeddings_name, ".random_oov" if config.bpe_merges else "")
+    if os.path.exists(cache_path):
+        print("Loading cached embedding matrix %s" % cache_path)
+        return np.load(cache_path, mmap_mode="r")
+
     EMBEDDING_DIM = config.size
     embeddings_index = {}
-    f = open(os.path.expanduser(config.embeddings_path), 'rb')
-    for line in f:
-        values = line.split()
-        word = values[0]
-        coefs = np.asarray(values[1:], dtype='float32')
-        embeddings_index[word] = coefs
-    f.close()
+    with open(os.path.expanduser(config.embeddings_path), encoding="utf-8") as f:
+        for line in f:
+            values = line.split()
+            word = values[0]
+            coefs = np.asarray(values[1:], dtype='float32')
+            embeddings_index[word] = coefs
 
     print('Found %s word vectors.' % len(embeddings_index))
 
-    embedding_matrix = np.zeros((config.vocab_size, EMBEDDING_DIM))
+    embedding_matrix = np.zeros((config.vocab_size, EMBEDDING_DIM), dtype=np.float32)
+    found = np.zeros(config.vocab_size, dtype=bool)
     for word, i in word_index.items():
         embedding_vector = embeddings_index.get(word.lower())
         if embedding_vector is not None:
             # words not found in embedding index will be all-zeros.
             embedding_matrix[i] = embedding_vector
+            found[i] = True
+
+    if config.bpe_merges:
+        scale = embedding_matrix[found].std() if found.any() else 1.0 / math.sqrt(EMBEDDING_DIM)
+        rng = np.random.RandomState(config.shuffle_seed)
+        embedding_matrix[~found] = rng.normal(scale=scale, size=(np.sum(~found), EMBEDDING_DIM))
+        print("Randomly initialized %d of %d subword embeddings without a pretrained vector."
+              % (np.sum(~found), config.vocab_size))
 
+    np.save(cache_path, embedding_matrix)
     return embedding_matrix
 
 
-def train(config):
+def train(config, cluster=None, server=None):
     # Prepare WMT data.
     print("Preparing WMT data in %s" % config.data_dir)
-    train, dev, _ = data_utils.prepare_wmt_data(config.data_dir, config.vocab_size)
+    train, dev, _ = data_utils.prepare_wmt_data(config.data_dir, config.vocab_size,
+                                                bpe_merges=config.bpe_merges, train_glob=config.train_glob)
 
-    with tf.Session() as sess:
-        if not os.path.exists(FLAGS.model_dir):
-            os.makedirs(FLAGS.model_dir)
+    if not os.path.exists(FLAGS.model_dir):
+        os.makedirs(FLAGS.model_dir)
+
+    # Load vocabularies.
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
+    vocab, _ = data_utils.initialize_vocabulary(vocab_path)
+
+    # Create model.
+    print("Creating %d layers of %d units." % (config.num_layers, config.size))
+    if config.num_towers > 1:
+        print("Splitting each batch of %d across %d towers." % (config.batch_size, config.num_towers))
+    is_chief = cluster is None or FLAGS.task_index == 0
+    if cluster is None:
+        sess = tf.Session(config=session_config(config))
+        model = create_model(sess, config, False, vocab)
+    else:
+        model, sess = create_distributed_model(config, cluster, server, vocab)
 
-        # Create model.
-        print("Creating %d layers of %d units." % (config.num_layers, config.size))
-        model = create_model(sess, config, False)
+    with sess:
+        profiler = model.profiler = create_profiler()
 
         if not config.probabilistic:
             model.kl_rate_update(0.0)
 
-        train_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "train"), graph=sess.graph)
-        dev_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "test"), graph=sess.graph)
+        if is_chief:
+            train_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "train"), graph=sess.graph)
+            dev_writer = tf.summary.FileWriter(os.path.join(FLAGS.model_dir, "test"), graph=sess.graph)
 
         # Read data into buckets and compute their sizes.
         print("Reading development and training data (limit: %d)."
@@ -191,66 +434,58 @@ def train(config):
         dev_set = read_data(dev, config)
         train_set = read_data(train, config, config.max_train_data_size)
         train_bucket_sizes = [len(train_set[b]) for b in xrange(len(config.buckets))]
-        train_total_size = float(sum(train_bucket_sizes))
-
-        # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-        # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-        # the size if i-th training bucket, as used later.
-        train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                               for i in xrange(len(train_bucket_sizes))]
-
-        # Load vocabularies.
-        vocab_path = os.path.join(config.data_dir, "vocab%d" % config.vocab_size)
-        vocab, _ = data_utils.initialize_vocabulary(vocab_path)
-
-        # Load word embeddings
-        print("Loading pretrained word embeddings.")
-        with tf.variable_scope("", reuse=True):
-            enc_embedding = tf.get_variable("enc_embedding")
-            dec_embedding = tf.get_variable("dec_embedding")
-
-            embedding_matrix = load_embeddings(vocab, config)
-
-            sess.run(tf.assign(enc_embedding, embedding_matrix))
-            sess.run(tf.assign(dec_embedding, embedding_matrix))
+        sampler = create_sampler(config, train_bucket_sizes, is_chief,
+                                 train if isinstance(train, list) else [train])
 
         # This is the training loop.
         print("Starting training loop.")
         step_time, loss = 0.0, 0.0
         KL_loss = 0.0
         current_step = model.global_step.eval()
+        last_report_step = current_step
         step_loss_summaries = []
         step_KL_loss_summaries = []
         overall_start_time = time.time()
-        while True:
-            # Choose a bucket according to data distribution. We pick a random number
-            # in [0, 1] and use the corresponding interval in train_buckets_scale.
-            random_number_01 = np.random.random_sample()
-            bucket_id = min([i for i in xrange(len(train_buckets_scale))
-                             if train_buckets_scale[i] > random_number_01])
+        budget = create_budget(config)
+        start_step, num_tokens, stop_reason = current_step, 0, None
+        mean_eval_ppx = None
+        while stop_reason is None:
+            # Take the next batch of the epoch; buckets come up in proportion to their size.
+            start_time = time.time()
+            with profiler.phase("sample bucket"):
+                bucket_id, indices = sampler.next_batch()
 
             # Get a batch and make a step.
-            start_time = time.time()
-            encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                train_set, bucket_id)
+            with profiler.phase("get_batch"):
+                encoder_inputs, decoder_inputs, target_weights = model.make_batch(
+                    [train_set[bucket_id][i] for i in indices], bucket_id)
             _, step_loss, step_KL_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
                                                        target_weights, bucket_id, False, config.probabilistic)
 
-            if config.anneal and model.global_step.eval() > config.kl_rate_rise_time and model.kl_rate < 1:
-                new_kl_rate = model.kl_rate.eval() + config.kl_rate_rise_factor
-                sess.run(model.kl_rate_update, feed_dict={'new_kl_rate': new_kl_rate})
+            with profiler.phase("anneal"):
+                if config.anneal and model.global_step.eval() > config.kl_rate_rise_time and model.kl_rate < 1:
+                    new_kl_rate = model.kl_rate.eval() + config.kl_rate_rise_factor
+                    sess.run(model.kl_rate_update, feed_dict={'new_kl_rate': new_kl_rate})
 
             step_time += (time.time() - start_time) / config.steps_per_checkpoint
-            step_loss_summaries.append(
-                tf.Summary(value=[tf.Summary.Value(tag="step loss", simple_value=float(step_loss))]))
-            step_KL_loss_summaries.append(
-                tf.Summary(value=[tf.Summary.Value(tag="KL step loss", simple_value=float(step_KL_loss))]))
+            with profiler.phase("summary"):
+                step_loss_summaries.append(
+                    tf.Summary(value=[tf.Summary.Value(tag="step loss", simple_value=float(step_loss))]))
+                step_KL_loss_summaries.append(
+                    tf.Summary(value=[tf.Summary.Value(tag="KL step loss", simple_value=float(step_KL_loss))]))
             loss += step_loss / config.steps_per_checkpoint
             KL_loss += step_KL_loss / config.steps_per_checkpoint
+            num_tokens += int(sum(np.sum(w) for w in target_weights))
             current_step = model.global_step.eval()
+            profiler.step_end()
+            epochs = sampler.epochs()
+            stop_reason = budget.exhausted(current_step, time.time() - overall_start_time, epochs)
 
             # Once in a while, we save checkpoint, print statistics, and run evals.
-            if current_step % config.steps_per_checkpoint == 0:
+            # Other workers also advance global_step, so compare checkpoint periods
+            # rather than requiring current_step to hit an exact multiple.
+            if current_step // config.steps_per_checkpoint > last_report_step // config.steps_per_checkpoint:
+                last_report_step = current_step
                 # Print statistics for the previous epoch.
                 perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
                 print("global step %d learning rate %.4f step-time %.2f perplexity "
@@ -263,161 +498,361 @@ def train(config):
                 wall_time = time.time() - overall_start_time
                 print("time passed: {0}".format(wall_time))
 
-                # Add perplexity, KL divergence to summary and stats.
-                perp_summary = tf.Summary(value=[tf.Summary.Value(tag="train perplexity", simple_value=perplexity)])
-                train_writer.add_summary(perp_summary, current_step)
-                KL_loss_summary = tf.Summary(value=[tf.Summary.Value(tag="KL divergence", simple_value=KL_loss)])
-                train_writer.add_summary(KL_loss_summary, current_step)
-                for i, summary in enumerate(step_loss_summaries):
-                    train_writer.add_summary(summary, current_step - 200 + i)
-                step_loss_summaries = []
-                for i, summary in enumerate(step_KL_loss_summaries):
-                    train_writer.add_summary(summary, current_step - 200 + i)
-                step_KL_loss_summaries = []
-
-                # Save checkpoint and zero timer and loss.
-                checkpoint_path = os.path.join(FLAGS.model_dir, FLAGS.model_name + ".ckpt")
-                model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                # Only the chief writes summaries and checkpoints and runs evals.
+                if is_chief:
+                    # Add perplexity, KL divergence to summary and stats.
+                    with profiler.phase("summary"):
+                        perp_summary = tf.Summary(value=[tf.Summary.Value(tag="train perplexity",
+                                                                          simple_value=perplexity)])
+                        train_writer.add_summary(perp_summary, current_step)
+                        KL_loss_summary = tf.Summary(value=[tf.Summary.Value(tag="KL divergence", simple_value=KL_loss)])
+                        train_writer.add_summary(KL_loss_summary, current_step)
+                        for i, summary in enumerate(step_loss_summaries):
+                            train_writer.add_summary(summary, current_step - 200 + i)
+                        for i, summary in enumerate(step_KL_loss_summaries):
+                            train_writer.add_summary(summary, current_step - 200 + i)
+
+                # Zero timer and loss.
                 step_time, loss, KL_loss = 0.0, 0.0, 0.0
-
-                # Run evals on development set and print their perplexity.
-                eval_losses = []
-                eval_KL_losses = []
-                eval_bucket_num = 0
-                for bucket_id in xrange(len(config.buckets)):
-                    if len(dev_set[bucket_id]) == 0:
-                        print("  eval: empty bucket %d" % (bucket_id))
-                        continue
-                    eval_bucket_num += 1
-                    encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                        dev_set, bucket_id)
-                    _, eval_loss, eval_KL_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                                               target_weights, bucket_id, True, config.probabilistic)
-                    eval_losses.append(float(eval_loss))
-                    eval_KL_losses.append(float(eval_KL_loss))
-                    eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-                        "inf")
-                    print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
-
-                    eval_perp_summary = tf.Summary(value=[
-                        tf.Summary.Value(tag="eval perplexity for bucket {0}".format(bucket_id),
-                                         simple_value=eval_ppx)])
-                    dev_writer.add_summary(eval_perp_summary, current_step)
-
-                mean_eval_loss = sum(eval_losses) / float(eval_bucket_num)
-                mean_eval_KL_loss = sum(eval_KL_losses) / float(eval_bucket_num)
-                mean_eval_ppx = math.exp(float(mean_eval_loss))
-                print("  eval: mean perplexity {0}".format(mean_eval_ppx))
-
-                eval_loss_summary = tf.Summary(
-                    value=[tf.Summary.Value(tag="mean eval loss", simple_value=float(mean_eval_ppx))])
-                dev_writer.add_summary(eval_loss_summary, current_step)
-                eval_KL_loss_summary = tf.Summary(
-                    value=[tf.Summary.Value(tag="mean eval loss", simple_value=float(mean_eval_KL_loss))])
-                dev_writer.add_summary(eval_KL_loss_summary, current_step)
+                step_loss_summaries, step_KL_loss_summaries = [], []
+
+                if is_chief:
+                    # Run evals on the whole development set and print their perplexity.
+                    with profiler.phase("eval"):
+                        bucket_losses = evaluate_dev_set(sess, model, dev_set, config)
+                    eval_losses, eval_KL_losses, eval_sizes = [], [], []
+                    for bucket_id in xrange(len(config.buckets)):
+                        if bucket_id not in bucket_losses:
+                            print("  eval: empty bucket %d" % (bucket_id))
+                            continue
+                        eval_loss, eval_KL_loss = bucket_losses[bucket_id]
+                        eval_losses.append(eval_loss)
+                        eval_KL_losses.append(eval_KL_loss)
+                        eval_sizes.append(len(dev_set[bucket_id]))
+                        eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
+                            "inf")
+                        print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+
+                        eval_perp_summary = tf.Summary(value=[
+                            tf.Summary.Value(tag="eval perplexity for bucket {0}".format(bucket_id),
+                                             simple_value=eval_ppx)])
+                        dev_writer.add_summary(eval_perp_summary, current_step)
+
+                    # Weight the buckets by their number of examples.
+                    num_eval = float(sum(eval_sizes))
+                    mean_eval_loss = sum(l * n for l, n in zip(eval_losses, eval_sizes)) / num_eval
+                    mean_eval_KL_loss = sum(l * n for l, n in zip(eval_KL_losses, eval_sizes)) / num_eval
+                    mean_eval_ppx = math.exp(float(mean_eval_loss)) if mean_eval_loss < 300 else float("inf")
+                    print("  eval: mean perplexity {0}".format(mean_eval_ppx))
+
+                    eval_loss_summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="mean eval loss", simple_value=float(mean_eval_ppx))])
+                    dev_writer.add_summary(eval_loss_summary, current_step)
+                    eval_KL_loss_summary = tf.Summary(
+                        value=[tf.Summary.Value(tag="mean eval loss", simple_value=float(mean_eval_KL_loss))])
+                    dev_writer.add_summary(eval_KL_loss_summary, current_step)
+
+                    # The dev loss tracked for the best checkpoint and patience is the negative ELBO.
+                    dev_elbo = -(mean_eval_loss + mean_eval_KL_loss)
+                    if budget.record_eval(current_step, -dev_elbo):
+                        with profiler.phase("checkpoint"):
+                            model.best_saver.save(sess, os.path.join(FLAGS.model_dir, BEST_CHECKPOINT),
+                                                  latest_filename="best_checkpoint")
+                            write_json_atomic(os.path.join(FLAGS.model_dir, "best.json"),
+                                              {"step": int(current_step), "dev_elbo": dev_elbo})
+                        print("  eval: new best dev ELBO %.4f" % dev_elbo)
+
+                    # Save the checkpoint after the evals, so that its sampler state holds the
+                    # RNG states training continues from.
+                    with profiler.phase("checkpoint"):
+                        save_checkpoint(sess, model, sampler)
+                    profiler.write_trace()
+                    stop_reason = stop_reason or budget.exhausted(
+                        current_step, time.time() - overall_start_time, epochs)
+
+        wall_time = time.time() - overall_start_time
+        print("Stopping training: %s." % stop_reason)
+        if is_chief:
+            if current_step != last_report_step:
+                save_checkpoint(sess, model, sampler)
+            profiler.write_trace()
+            summary = {"stop_reason": stop_reason,
+                       "global_step": int(current_step),
+                       "steps": int(current_step - start_step),
+                       "epochs": epochs,
+                       "tokens": num_tokens,
+                       "wall_time": wall_time,
+                       "tokens_per_second": num_tokens / max(wall_time, 1e-9),
+                       "steps_per_second": (current_step - start_step) / max(wall_time, 1e-9),
+                       "dev_perplexity": mean_eval_ppx,
+                       "best_step": budget.best_step,
+                       "best_dev_elbo": None if budget.best_loss is None else -budget.best_loss}
+            write_json_atomic(os.path.join(FLAGS.model_dir, "train_summary.json"), summary)
+        print("Trained %d steps (%d tokens) in %.1fs." % (current_step - start_step, num_tokens, wall_time))
+
+
+def evaluate_dev_set(sess, model, dev_set, config):
+    """Score every development example, in order, with model.batch_size examples per step.
+
+    The last batch of a bucket is filled up with repeats of its own examples,
+    since step averages its losses over the whole batch.
+
+    Returns:
+      A dict from the id of each non-empty bucket to its mean (loss, KL_loss).
+    """
+    bucket_losses = {}
+    for bucket_id, examples in enumerate(dev_set):
+        if not examples:
+            continue
+        total_loss, total_KL_loss = 0.0, 0.0
+        for i in xrange(0, len(examples), model.batch_size):
+            batch = examples[i:i + model.batch_size]
+            filled = (batch * int(math.ceil(model.batch_size / float(len(batch)))))[:model.batch_size]
+            encoder_inputs, decoder_inputs, target_weights = model.make_batch(filled, bucket_id)
+            _, eval_loss, eval_KL_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                                       target_weights, bucket_id, True, config.probabilistic)
+            total_loss += float(eval_loss) * len(batch)
+            total_KL_loss += float(eval_KL_loss) * len(batch)
+        bucket_losses[bucket_id] = (total_loss / len(examples), total_KL_loss / len(examples))
+    return bucket_losses
+
+
+def save_checkpoint(sess, model, sampler):
+    """Save a training checkpoint and the sampler state next to it, as <checkpoint>.sampler.json."""
+    checkpoint_path = os.path.join(FLAGS.model_dir, FLAGS.model_name + ".ckpt")
+    path = model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+    write_json_atomic(path + SAMPLER_SUFFIX, sampler.state())
+    # Drop the sampler states of the checkpoints the saver has deleted.
+    for state_path in gfile.Glob(checkpoint_path + "-*" + SAMPLER_SUFFIX):
+        if not tf.train.checkpoint_exists(state_path[:-len(SAMPLER_SUFFIX)]):
+            gfile.Remove(state_path)
+
+
+def create_sampler(config, bucket_sizes, is_chief, shards):
+    """Create the training batch sampler, resuming from the state saved with the checkpoint if any.
+
+    Only the chief saves states, so other distributed workers always start a
+    fresh order of their own. If the training shards changed since the state
+    was saved, training resumes at the start of the next epoch.
+    """
+    ckpt = tf.train.get_checkpoint_state(FLAGS.model_dir)
+    if is_chief and not FLAGS.new and ckpt:
+        state_path = ckpt.model_checkpoint_path + SAMPLER_SUFFIX
+        if os.path.exists(state_path):
+            print("Resuming the data order from %s" % state_path)
+            with open(state_path) as f:
+                sampler = EpochSampler.restore(json.load(f), bucket_sizes, config.batch_size, shards)
+            if sampler.cursor == 0:
+                print("The training data changed; starting epoch %d." % sampler.epoch)
+            return sampler
+        print("No sampler state for %s; starting a new data order." % ckpt.model_checkpoint_path)
+    seed = config.shuffle_seed + (0 if is_chief else FLAGS.task_index)
+    return EpochSampler(bucket_sizes, config.batch_size, seed=seed, shards=shards)
+
+
+def create_budget(config):
+    """Create the training budget configured in config, resuming the best dev loss from best.json."""
+    best_loss, best_step = None, None
+    best_path = os.path.join(FLAGS.model_dir, "best.json")
+    if not FLAGS.new and os.path.exists(best_path):
+        with open(best_path) as f:
+            best = json.load(f)
+        best_loss, best_step = -best["dev_elbo"], best["step"]
+    return TrainingBudget(max_steps=config.max_steps, max_time=config.max_time, max_epochs=config.max_epochs,
+                          patience=config.patience, best_loss=best_loss, best_step=best_step)
+
+
+def detokenize(config, words):
+    """Join decoded tokens into a sentence, merging BPE subwords if used."""
+    if config.bpe_merges:
+        return data_utils.bpe_detokenize(words)
+    return " ".join(words)
 
 
 def reconstruct(sess, model, config):
-    model.batch_size = 1  # We decode one sentence at a time.
-    model.probabilistic = config.probabilistic
+    """Reconstruct every line of FLAGS.input into FLAGS.output, see reconstruct_file."""
+    reconstruct_file(sess, model, config, FLAGS.input, FLAGS.output)
+    if model.profiler.enabled:
+        print(model.profiler.summary())
+        model.profiler.write_trace()
+    if model.cache is not None:
+        print(model.cache.summary())
+
+
+def reconstruct_file(sess, model, config, input_path, output_path, offset=0, max_lines=None):
+    """Reconstruct the lines of input_path into output_path.
+
+    The input is read chunk_size lines at a time. Greedy reconstructions are
+    decoded in batches of batch_size per bucket, beam search one sentence at a
+    time. Each chunk's outputs are written and flushed before the next chunk
+    is read, and the number of lines done is recorded in <output_path>.progress;
+    rerunning after an interruption resumes after the last finished chunk.
+
+    Args:
+      offset: byte offset of the first line to reconstruct.
+      max_lines: number of lines to reconstruct from there; None for all.
+    """
     beam_size = config.beam_size
+    model.batch_size = config.batch_size if beam_size == 1 else 1
+    model.probabilistic = config.probabilistic
+    profiler = model.profiler
+    # Sampled or beam-searched reconstructions are not cached.
+    cache = model.cache if beam_size == 1 and not config.probabilistic else None
+    if cache is not None:
+        cache.set_checkpoint(model.checkpoint_id)
 
     # Load vocabularies.
-    vocab_path = os.path.join(config.data_dir, "vocab%d" % config.vocab_size)
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
     vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+    tokenizer = data_utils.get_tokenizer(config.data_dir, config.bpe_merges)
 
-    # Decode from standard input.
-    outputs = []
-    with gfile.GFile(FLAGS.input, "r") as fs:
-        sentences = fs.readlines()
-    for i, sentence in enumerate(sentences):
-        # Get token-ids for the input sentence.
-        token_ids = data_utils.sentence_to_token_ids(sentence, vocab)
-        # Which bucket does it belong to?
-        bucket_id = len(config.buckets) - 1
-        for i, bucket in enumerate(config.buckets):
-            if bucket[0] >= len(token_ids):
-                bucket_id = i
+    def to_sentence(output):
+        # If there is an EOS symbol in outputs, cut them at that point.
+        if data_utils.EOS_ID in output:
+            output = output[:output.index(data_utils.EOS_ID)]
+        return detokenize(config, [rev_vocab[word] for word in output]) + "\n"
+
+    input_path = os.path.abspath(input_path)
+    progress_path = output_path + ".progress"
+    num_lines, output_bytes = 0, 0
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress["input"] != input_path:
+            raise ValueError("%s records a run on %s; remove it to start over." % (progress_path, progress["input"]))
+        num_lines, output_bytes = progress["lines"], progress["output_bytes"]
+        print("Resuming after line %d." % num_lines)
+
+    with gfile.GFile(input_path, "rb") as fs, open(output_path, "r+" if num_lines else "w") as enc_dec_f:
+        # Drop whatever was written after the last recorded chunk.
+        enc_dec_f.truncate(output_bytes)
+        enc_dec_f.seek(output_bytes)
+        if offset:
+            fs.seek(offset)
+        lines = itertools.islice(fs, num_lines, max_lines)
+        while True:
+            sentences = [line.decode("utf-8") for line in itertools.islice(lines, config.chunk_size)]
+            if not sentences:
                 break
-        else:
-            logging.warning("Sentence truncated: %s", sentence)
-
-        encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-            {bucket_id: [(token_ids, [])]}, bucket_id)
-
-        if beam_size > 1:
-            path, symbol, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                                     target_weights, bucket_id, True, config.probabilistic, beam_size)
-
-            k = output_logits[0]
-            paths = []
-            for kk in range(beam_size):
-                paths.append([])
-            curr = list(range(beam_size))
-            num_steps = len(path)
-            for i in range(num_steps - 1, -1, -1):
-                for kk in range(beam_size):
-                    paths[kk].append(symbol[i][curr[kk]])
-                    curr[kk] = path[i][curr[kk]]
-            recos = set()
-            for kk in range(beam_size):
-                output = [int(logit) for logit in paths[kk][::-1]]
-
-                if data_utils.EOS_ID in output:
-                    output = output[:output.index(data_utils.EOS_ID)]
-                output = " ".join([rev_vocab[word] for word in output]) + "\n"
-                outputs.append(output)
-
-        else:
-            # Get output logits for the sentence.
-            _, _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                                target_weights, bucket_id, True, config.probabilistic)
-            # This is a greedy decoder - outputs are just argmaxes of output_logits.
-            output = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-            # If there is an EOS symbol in outputs, cut them at that point.
-            if data_utils.EOS_ID in output:
-                output = output[:output.index(data_utils.EOS_ID)]
-            output = " ".join([rev_vocab[word] for word in output]) + "\n"
-            outputs.append(output)
-    with gfile.GFile(FLAGS.output, "w") as enc_dec_f:
-        for output in outputs:
-            enc_dec_f.write(output)
+            outputs = [None] * len(sentences)
+            by_bucket = [[] for _ in config.buckets]
+            for k, sentence in enumerate(sentences):
+                with profiler.phase("tokenize"):
+                    # Get token-ids for the input sentence.
+                    token_ids = data_utils.sentence_to_token_ids(sentence, vocab, tokenizer)
+                    # Which bucket does it belong to?
+                    bucket_id = len(config.buckets) - 1
+                    for b, bucket in enumerate(config.buckets):
+                        if bucket[0] >= len(token_ids):
+                            bucket_id = b
+                            break
+                    else:
+                        logging.warning("Sentence truncated: %s", sentence)
+                if cache is not None:
+                    outputs[k] = cache.get(("reconstruct", tuple(token_ids)))
+                    if outputs[k] is not None:
+                        profiler.step_end()
+                        continue
+                by_bucket[bucket_id].append((k, token_ids))
+
+            for bucket_id, items in enumerate(by_bucket):
+                for start in xrange(0, len(items), model.batch_size):
+                    batch = items[start:start + model.batch_size]
+                    with profiler.phase("get_batch"):
+                        encoder_inputs, decoder_inputs, target_weights = model.make_batch(
+                            [(token_ids, []) for _, token_ids in batch], bucket_id)
+
+                    if beam_size > 1:
+                        path, symbol, output_logits = model.step(sess, encoder_inputs, decoder_inputs, target_weights,
+                                                                 bucket_id, True, config.probabilistic, beam_size)
+                        paths = []
+                        for kk in range(beam_size):
+                            paths.append([])
+                        curr = list(range(beam_size))
+                        num_steps = len(path)
+                        for i in range(num_steps - 1, -1, -1):
+                            for kk in range(beam_size):
+                                paths[kk].append(symbol[i][curr[kk]])
+                                curr[kk] = path[i][curr[kk]]
+                        outputs[batch[0][0]] = "".join(
+                            to_sentence([int(logit) for logit in paths[kk][::-1]]) for kk in range(beam_size))
+                    else:
+                        # Get output logits for the batch.
+                        _, _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                                            target_weights, bucket_id, True, config.probabilistic)
+                        with profiler.phase("detokenize"):
+                            # This is a greedy decoder - outputs are just argmaxes of output_logits.
+                            ids = np.stack(model.output_ids(output_logits), axis=1)
+                            for (k, token_ids), row in zip(batch, ids):
+                                outputs[k] = to_sentence([int(i) for i in row])
+                                if cache is not None:
+                                    cache.put(("reconstruct", tuple(token_ids)), outputs[k])
+                    profiler.step_end()
+
+            with profiler.phase("write"):
+                for output in outputs:
+                    enc_dec_f.write(output)
+                enc_dec_f.flush()
+                num_lines += len(sentences)
+                write_json_atomic(progress_path, {"input": input_path, "lines": num_lines,
+                                                  "output_bytes": enc_dec_f.tell()})
+            print("  reconstructed %d lines of %s" % (num_lines, output_path))
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
 
 
 def encode(sess, model, config, sentences):
     # Load vocabularies.
-    vocab_path = os.path.join(config.data_dir,
-                              "vocab%d" % config.vocab_size)
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
     vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+    tokenizer = data_utils.get_tokenizer(config.data_dir, config.bpe_merges)
 
+    profiler = model.profiler
+    cache = model.cache
+    if cache is not None:
+        cache.set_checkpoint(model.checkpoint_id)
     means = []
     logvars = []
     for i, sentence in enumerate(sentences):
-        # Get token-ids for the input sentence.
-        token_ids = data_utils.sentence_to_token_ids(sentence, vocab)
-        # Which bucket does it belong to?
-        bucket_id = len(config.buckets) - 1
-        for i, bucket in enumerate(config.buckets):
-            if bucket[0] >= len(token_ids):
-                bucket_id = i
-                break
-        else:
-            logging.warning("Sentence truncated: %s", sentence)
+        with profiler.phase("tokenize"):
+            # Get token-ids for the input sentence.
+            token_ids = data_utils.sentence_to_token_ids(sentence, vocab, tokenizer)
+            # Which bucket does it belong to?
+            bucket_id = len(config.buckets) - 1
+            for i, bucket in enumerate(config.buckets):
+                if bucket[0] >= len(token_ids):
+                    bucket_id = i
+                    break
+            else:
+                logging.warning("Sentence truncated: %s", sentence)
 
+        cache_key = ("encode", tuple(token_ids))
+        cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            mean, logvar = cached
+        else:
             # Get a 1-element batch to feed the sentence to the model.
-        encoder_inputs, _, _ = model.get_batch(
-            {bucket_id: [(token_ids, [])]}, bucket_id)
-        # Get output logits for the sentence.
-        mean, logvar = model.encode_to_latent(sess, encoder_inputs, bucket_id)
+            with profiler.phase("get_batch"):
+                encoder_inputs, _, _ = model.get_batch(
+                    {bucket_id: [(token_ids, [])]}, bucket_id)
+            # Get output logits for the sentence.
+            mean, logvar = model.encode_to_latent(sess, encoder_inputs, bucket_id)
+            if cache is not None:
+                cache.put(cache_key, (mean, logvar))
         means.append(mean)
         logvars.append(logvar)
+        profiler.step_end()
 
+    if profiler.enabled:
+        print(profiler.summary())
+        profiler.write_trace()
+    if cache is not None:
+        print(cache.summary())
     return means, logvars
 
 
 def decode(sess, model, config, means, logvars, bucket_id):
-    vocab_path = os.path.join(config.data_dir,
-                              "vocab%d" % config.vocab_size)
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
     _, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
 
     _, decoder_inputs, target_weights = model.get_batch(
@@ -427,16 +862,117 @@ def decode(sess, model, config, means, logvars, bucket_id):
         mean = mean.reshape(1, -1)
         logvar = logvar.reshape(1, -1)
         output_logits = model.decode_from_latent(sess, mean, logvar, bucket_id, decoder_inputs, target_weights)
-        output = [int(np.argmax(logit, axis=1)) for logit in output_logits]
+        output = [int(ids) for ids in model.output_ids(output_logits)]
         # If there is an EOS symbol in outputs, cut them at that point.
         if data_utils.EOS_ID in output:
             output = output[:output.index(data_utils.EOS_ID)]
-        output = " ".join([rev_vocab[word] for word in output]) + "\n"
+        output = detokenize(config, [rev_vocab[word] for word in output]) + "\n"
         outputs.append(output)
 
     return outputs
 
 
+def greedy_decode_set(sess, model, data_set):
+    """Greedily reconstruct every example of data_set from its posterior mean.
+
+    Returns a list with one [num_examples x decoder_size] array of predicted
+    token ids per bucket, and the seconds spent.
+    """
+    predictions = []
+    start_time = time.time()
+    for bucket_id, examples in enumerate(data_set):
+        bucket_predictions = [np.zeros((0, model.buckets[bucket_id][1]), dtype=np.int64)]
+        for i in xrange(0, len(examples), model.batch_size):
+            batch = examples[i:i + model.batch_size]
+            encoder_inputs, decoder_inputs, target_weights = model.make_batch(batch, bucket_id)
+            _, _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                                target_weights, bucket_id, True, False)
+            ids = np.stack(model.output_ids(output_logits), axis=1)
+            bucket_predictions.append(ids[:len(batch)])
+        predictions.append(np.concatenate(bucket_predictions))
+    return predictions, time.time() - start_time
+
+
+def evaluate_quantization(config):
+    """Compare greedy reconstructions with the float32 and the int8 output projection on the dev set."""
+    _, dev, _ = data_utils.prepare_wmt_data(config.data_dir, config.vocab_size,
+                                            bpe_merges=config.bpe_merges, train_glob=config.train_glob)
+    dev_set = read_data(dev, config)
+
+    predictions, seconds = {}, {}
+    for name, quantize in (("float32", False), ("int8", True)):
+        config.update(quantize_projection=quantize)
+        with tf.Graph().as_default(), tf.Session() as sess:
+            model = create_model(sess, config, True)
+            predictions[name], seconds[name] = greedy_decode_set(sess, model, dev_set)
+
+    num_tokens, num_sentences = 0, 0
+    correct = {"float32": 0, "int8": 0}
+    agreeing_tokens, agreeing_sentences = 0, 0
+    for bucket_id, examples in enumerate(dev_set):
+        for k, (_, target) in enumerate(examples):
+            target = np.array(target)
+            float_ids = predictions["float32"][bucket_id][k][:len(target)]
+            int8_ids = predictions["int8"][bucket_id][k][:len(target)]
+            num_tokens += len(target)
+            num_sentences += 1
+            correct["float32"] += int(np.sum(float_ids == target))
+            correct["int8"] += int(np.sum(int8_ids == target))
+            agreeing_tokens += int(np.sum(float_ids == int8_ids))
+            agreeing_sentences += int(np.array_equal(float_ids, int8_ids))
+
+    num_tokens = max(num_tokens, 1)
+    for name in ("float32", "int8"):
+        print("%-7s token accuracy %.4f, decode time %.2fs" % (name, correct[name] / num_tokens, seconds[name]))
+    print("accuracy difference (int8 - float32): %+.4f" % ((correct["int8"] - correct["float32"]) / num_tokens))
+    print("int8 agrees with float32 on %.4f of tokens and %.4f of %d sentences" % (
+        agreeing_tokens / num_tokens, agreeing_sentences / max(num_sentences, 1), num_sentences))
+
+
+def evaluate_iw(config):
+    """Report the importance-weighted bound on the negative log-likelihood of the iw_data corpus.
+
+    Each session.run scores batch_size * iw_samples tiled examples; batch_size
+    is chosen so that this stays within iw_batch_rows.
+    """
+    if config.iw_samples < 1:
+        raise ValueError("iw_samples must be positive, got %d." % config.iw_samples)
+    data_utils.prepare_wmt_data(config.data_dir, config.vocab_size,
+                                bpe_merges=config.bpe_merges, train_glob=config.train_glob)
+    eval_set = read_data(data_utils.prepare_eval_data(config.data_dir, config.iw_data, config.vocab_size,
+                                                      config.bpe_merges), config)
+    config.update(batch_size=max(1, config.iw_batch_rows // config.iw_samples))
+
+    with tf.Session(config=session_config(config)) as sess:
+        model = create_model(sess, config, True)
+        model.profiler = create_profiler()
+        total_bound, total_elbo = 0.0, 0.0
+        num_tokens, num_sentences = 0, 0
+        start_time = time.time()
+        for bucket_id, examples in enumerate(eval_set):
+            for i in xrange(0, len(examples), model.batch_size):
+                batch = examples[i:i + model.batch_size]
+                encoder_inputs, decoder_inputs, target_weights = model.make_batch(batch, bucket_id)
+                bounds, elbos = model.importance_weighted_step(sess, encoder_inputs, decoder_inputs,
+                                                               target_weights, bucket_id)
+                total_bound += float(np.sum(bounds[:len(batch)]))
+                total_elbo += float(np.sum(elbos[:len(batch)]))
+                num_tokens += sum(len(target) for _, target in batch)
+                num_sentences += len(batch)
+                model.profiler.step_end()
+
+    num_tokens, num_sentences = max(num_tokens, 1), max(num_sentences, 1)
+    print("evaluated %d sentences with %d samples each in %.2fs" % (
+        num_sentences, config.iw_samples, time.time() - start_time))
+    for name, total in (("ELBO", total_elbo), ("IW bound (k=%d)" % config.iw_samples, total_bound)):
+        nll = total / num_sentences
+        ppx = math.exp(total / num_tokens) if total / num_tokens < 300 else float("inf")
+        print("%-16s -log p(x) <= %.3f nats per sentence, perplexity <= %.2f" % (name, nll, ppx))
+    if model.profiler.enabled:
+        print(model.profiler.summary())
+        model.profiler.write_trace()
+
+
 def n_sample(sess, model, config):
     bucket_id = len(config.buckets) - 1
     with gfile.GFile(FLAGS.input, "r") as fs:
@@ -460,13 +996,7 @@ def interpolate(sess, model, config, means, logvars, num_pts):
     if num_pts < 3:
         raise ValueError("there should be more than two points when interpolating."
                          "number of points: %d." % num_pts)
-    pts = []
-    for s, e in zip(means[0][0].tolist(), means[1][0].tolist()):
-        pts.append(np.linspace(s, e, num_pts))
-
-    pts = np.array(pts)
-    pts = pts.T
-    pts = [np.array(pt) for pt in pts.tolist()]
+    pts = [pt for pt in lerp(means[0], means[1], num_pts)[0]]
     bucket_id = len(config.buckets) - 1
     logvars = [np.full(pt.shape, -800.0, dtype=np.float32) for pt in pts]
     outputs = decode(sess, model, config, pts, logvars, bucket_id)
@@ -475,8 +1005,9 @@ def interpolate(sess, model, config, means, logvars, num_pts):
 
 
 def encode_interpolate(sess, model, config):
+    # Only the first two lines are interpolated between.
     with gfile.GFile(FLAGS.input, "r") as fs:
-        sentences = fs.readlines()
+        sentences = list(itertools.islice(fs, 2))
     model.batch_size = 1
     model.probabilistic = config.probabilistic
     means, logvars = encode(sess, model, config, sentences)
@@ -488,6 +1019,482 @@ def encode_interpolate(sess, model, config):
         interp_f.write(sentences[1])
 
 
+def encode_means(sess, model, config, sentences, vocab, tokenizer=None):
+    """Posterior means of sentences, encoded in batches of model.batch_size per bucket.
+
+    Returns:
+      a [len(sentences) x latent_dim] array, in the order of sentences.
+    """
+    by_bucket = [[] for _ in config.buckets]
+    for i, sentence in enumerate(sentences):
+        token_ids = data_utils.sentence_to_token_ids(sentence, vocab, tokenizer)
+        bucket_id = len(config.buckets) - 1
+        for b, bucket in enumerate(config.buckets):
+            if bucket[0] >= len(token_ids):
+                bucket_id = b
+                break
+        else:
+            logging.warning("Sentence truncated: %s", sentence)
+        by_bucket[bucket_id].append((i, token_ids))
+
+    means = np.zeros((len(sentences), model.latent_dim), dtype=np.float32)
+    for bucket_id, items in enumerate(by_bucket):
+        for start in xrange(0, len(items), model.batch_size):
+            batch = items[start:start + model.batch_size]
+            encoder_inputs, _, _ = model.make_batch([(token_ids, []) for _, token_ids in batch], bucket_id)
+            batch_means, _ = model.encode_to_latent(sess, encoder_inputs, bucket_id)
+            means[[i for i, _ in batch]] = batch_means[:len(batch)]
+            model.profiler.step_end()
+    return means
+
+
+def decode_means(sess, model, config, means, rev_vocab):
+    """Greedily decode the rows of a [n x latent_dim] array in batches of model.batch_size.
+
+    Yields the n decoded sentences in order.
+    """
+    bucket_id = len(config.buckets) - 1
+    _, decoder_inputs, target_weights = model.make_batch([], bucket_id)
+    logvars = np.full((model.batch_size, model.latent_dim), -800.0, dtype=np.float32)
+    batch_means = np.zeros((model.batch_size, model.latent_dim), dtype=np.float32)
+    for start in xrange(0, len(means), model.batch_size):
+        batch_size = min(model.batch_size, len(means) - start)
+        batch_means[:batch_size] = means[start:start + batch_size]
+        output_logits = model.decode_from_latent(sess, batch_means, logvars, bucket_id,
+                                                 decoder_inputs, target_weights)
+        ids = np.stack(model.output_ids(output_logits), axis=1)
+        for row in ids[:batch_size]:
+            output = [int(i) for i in row]
+            # If there is an EOS symbol in outputs, cut them at that point.
+            if data_utils.EOS_ID in output:
+                output = output[:output.index(data_utils.EOS_ID)]
+            yield detokenize(config, [rev_vocab[word] for word in output])
+        model.profiler.step_end()
+
+
+def interpolate_pairs(sess, model, config):
+    """Interpolate between the two tab-separated sentences on every line of FLAGS.input.
+
+    Pairs are processed batch_size at a time: all endpoints are encoded in
+    bulk, the (pairs x num_pts x latent_dim) grid is built at once, and the
+    grid is decoded in batches and written out before the next chunk is read.
+    Every pair is written as in the interpolate mode, followed by an empty line.
+    """
+    interpolations = {"linear": lerp, "spherical": slerp}
+    if config.interpolation not in interpolations:
+        raise ValueError("interpolation is not one of the following: linear or spherical.")
+    if config.num_pts < 3:
+        raise ValueError("there should be more than two points when interpolating."
+                         "number of points: %d." % config.num_pts)
+    interpolate_f = interpolations[config.interpolation]
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
+    vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+    tokenizer = data_utils.get_tokenizer(config.data_dir, config.bpe_merges)
+    profiler = model.profiler
+
+    num_pairs = 0
+    with gfile.GFile(FLAGS.input, "r") as fs, gfile.GFile(FLAGS.output, "w") as interp_f:
+        while True:
+            lines = list(itertools.islice(fs, model.batch_size))
+            if not lines:
+                break
+            pairs = []
+            for line in lines:
+                pair = line.rstrip("\n").split("\t")
+                if len(pair) != 2:
+                    raise ValueError("line %d should contain two tab-separated sentences, got %d."
+                                     % (num_pairs + len(pairs) + 1, len(pair)))
+                pairs.append(pair)
+            means = encode_means(sess, model, config, [p[0] for p in pairs] + [p[1] for p in pairs],
+                                 vocab, tokenizer)
+            grid = interpolate_f(means[:len(pairs)], means[len(pairs):], config.num_pts)
+            outputs = decode_means(sess, model, config, grid.reshape(-1, model.latent_dim), rev_vocab)
+            for start, end in pairs:
+                interp_f.write(start + "\n")
+                for _ in xrange(config.num_pts):
+                    interp_f.write(next(outputs) + "\n")
+                interp_f.write(end + "\n\n")
+            num_pairs += len(pairs)
+            print("  interpolated %d pairs" % num_pairs)
+    if profiler.enabled:
+        print(profiler.summary())
+        profiler.write_trace()
+
+
+def shard_offsets(path, shard_size):
+    """Byte offsets of every shard_size-th line of path, and the number of lines."""
+    offsets = []
+    num_lines, position = 0, 0
+    with open(path, "rb") as f:
+        for line in f:
+            if num_lines % shard_size == 0:
+                offsets.append(position)
+            position += len(line)
+            num_lines += 1
+    return offsets, num_lines
+
+
+def write_json_atomic(path, obj):
+    """Write obj as JSON so that readers never see a partially written file."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _set_worker_flags(**values):
+    """Set flags in a spawned worker process.
+
+    A spawned process has the flag definitions but has not parsed sys.argv
+    yet; tf.app.flags parses it on the first read and would overwrite any
+    flag set before. So read one first, which parses the parent's command line.
+    """
+    FLAGS.model_dir  # pylint: disable=pointless-statement
+    for name, value in values.items():
+        setattr(FLAGS, name, value)
+
+
+# Per-process state of the encode_corpus worker pool, set up by _init_encode_worker.
+_encode_worker = {}
+
+
+def _init_encode_worker(config_entries, model_dir, num_threads):
+    # Workers are spawned, so the flags main() adjusted have to be set again.
+    _set_worker_flags(model_dir=model_dir, new=False)
+    config = Struct(**config_entries)
+    sess = tf.Session(config=tf.ConfigProto(inter_op_parallelism_threads=num_threads,
+                                            intra_op_parallelism_threads=num_threads))
+    model = create_model(sess, config, True)
+    vocab_path = data_utils.vocabulary_path(config.data_dir, config.vocab_size, config.bpe_merges)
+    vocab, _ = data_utils.initialize_vocabulary(vocab_path)
+    _encode_worker.update(config=config, sess=sess, model=model, vocab=vocab,
+                          tokenizer=data_utils.get_tokenizer(config.data_dir, config.bpe_merges))
+
+
+def _encode_shard(task):
+    """Encode one shard of the corpus into its .npy file, resuming from its progress file."""
+    shard_id, input_path, offset, num_rows, shard_path = task
+    config, model = _encode_worker["config"], _encode_worker["model"]
+    progress_path = shard_path + ".progress"
+    done = 0
+    if os.path.exists(shard_path) and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            done = int(f.read())
+        means = np.lib.format.open_memmap(shard_path, mode="r+")
+    else:
+        means = np.lib.format.open_memmap(shard_path, mode="w+", dtype=np.float32,
+                                          shape=(num_rows, config.latent_dim))
+    # Progress is made durable every chunk of 8 batches.
+    chunk_size = 8 * model.batch_size
+    with open(input_path, "rb") as f:
+        f.seek(offset)
+        lines = itertools.islice(f, done, num_rows)
+        while done < num_rows:
+            sentences = [line.decode("utf-8") for line in itertools.islice(lines, chunk_size)]
+            means[done:done + len(sentences)] = encode_means(
+                _encode_worker["sess"], model, config, sentences,
+                _encode_worker["vocab"], _encode_worker["tokenizer"])
+            done += len(sentences)
+            means.flush()
+            with open(progress_path + ".tmp", "w") as progress_f:
+                progress_f.write("%d" % done)
+            os.replace(progress_path + ".tmp", progress_path)
+    return shard_id
+
+
+def encode_corpus(config):
+    """Write the posterior means of every line of FLAGS.input as .npy shards to FLAGS.output.
+
+    Shard i holds lines [i * shard_size, (i + 1) * shard_size) in means-<i>.npy.
+    Shards are encoded by a pool of num_workers processes, each with its own
+    session capped at worker_threads threads. Workers fill memory-mapped shards
+    in place and record their row count in a .progress file; finished shards
+    are listed in manifest.json. Rerunning with the same input and output
+    skips finished shards and resumes the others where they stopped.
+    """
+    if not os.path.exists(FLAGS.output):
+        os.makedirs(FLAGS.output)
+    input_path = os.path.abspath(FLAGS.input)
+    manifest_path = os.path.join(FLAGS.output, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["input"] != input_path or manifest["shard_size"] != config.shard_size:
+            raise ValueError("%s was written for %s with shard_size %d; use another output directory."
+                             % (manifest_path, manifest["input"], manifest["shard_size"]))
+        print("Resuming: %d of %d shards done." % (len(manifest["completed"]), len(manifest["shards"])))
+    else:
+        offsets, num_lines = shard_offsets(input_path, config.shard_size)
+        shards = []
+        for i, offset in enumerate(offsets):
+            shards.append({"file": "means-%05d.npy" % i, "offset": offset,
+                           "num_rows": min(config.shard_size, num_lines - i * config.shard_size)})
+        manifest = {"input": input_path, "num_lines": num_lines, "shard_size": config.shard_size,
+                    "latent_dim": config.latent_dim, "shards": shards, "completed": []}
+        write_json_atomic(manifest_path, manifest)
+
+    tasks = [(i, input_path, shard["offset"], shard["num_rows"], os.path.join(FLAGS.output, shard["file"]))
+             for i, shard in enumerate(manifest["shards"]) if i not in manifest["completed"]]
+    start_time = time.time()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(config.num_workers, initializer=_init_encode_worker,
+                  initargs=(config.__dict__, FLAGS.model_dir, config.worker_threads)) as pool:
+        for shard_id in pool.imap_unordered(_encode_shard, tasks):
+            manifest["completed"] = sorted(manifest["completed"] + [shard_id])
+            write_json_atomic(manifest_path, manifest)
+            print("  shard %d done, %d of %d shards, %.1fs" % (
+                shard_id, len(manifest["completed"]), len(manifest["shards"]), time.time() - start_time))
+
+
+def core_groups(num_groups):
+    """Split the cores this process may run on into num_groups contiguous groups."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(multiprocessing.cpu_count()))
+    if num_groups > len(cores):
+        raise ValueError("num_workers (%d) exceeds the %d available cores." % (num_groups, len(cores)))
+    return [cores[i * len(cores) // num_groups:(i + 1) * len(cores) // num_groups] for i in range(num_groups)]
+
+
+# Per-process state of the reconstruct_parallel worker pool, set up by _init_reconstruct_worker.
+_reconstruct_worker = {}
+
+
+def _init_reconstruct_worker(config_entries, model_dir, core_queue):
+    # Workers are spawned, so the flags main() adjusted have to be set again.
+    _set_worker_flags(model_dir=model_dir, new=False)
+    # There is one group per initial worker; a worker the pool starts to replace
+    # a dead one finds the queue empty and keeps TensorFlow's default threads.
+    try:
+        cores = core_queue.get(timeout=CORE_QUEUE_TIMEOUT)
+    except queue.Empty:
+        print("Worker %d: no free group of cores; running unpinned." % os.getpid())
+        cores = []
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    config = Struct(**config_entries)
+    sess = tf.Session(config=tf.ConfigProto(inter_op_parallelism_threads=len(cores),
+                                            intra_op_parallelism_threads=len(cores)))
+    model = create_model(sess, config, True)
+    model.cache = create_cache(config, reconstruct=True)
+    _reconstruct_worker.update(config=config, sess=sess, model=model)
+
+
+def _reconstruct_shard(task):
+    shard_id, input_path, offset, num_lines, shard_path = task
+    reconstruct_file(_reconstruct_worker["sess"], _reconstruct_worker["model"], _reconstruct_worker["config"],
+                     input_path, shard_path, offset=offset, max_lines=num_lines)
+    return shard_id
+
+
+def reconstruct_parallel(config):
+    """Reconstruct FLAGS.input into FLAGS.output with a pool of num_workers processes.
+
+    The input is split into shards of shard_size lines, which workers
+    reconstruct with reconstruct_file into <output>.shards/part-<i>.txt. Every
+    worker has its own session, restored from the same checkpoint and pinned
+    to its own group of cores with as many threads. Finished shards are listed
+    in <output>.shards/manifest.json, so a rerun only redoes the others; once
+    all are done they are concatenated into FLAGS.output in input order.
+    """
+    # Check the cache settings here; a worker whose initializer fails is just restarted by the pool.
+    create_cache(config, reconstruct=True)
+    shards_dir = FLAGS.output + ".shards"
+    if not os.path.exists(shards_dir):
+        os.makedirs(shards_dir)
+    input_path = os.path.abspath(FLAGS.input)
+    manifest_path = os.path.join(shards_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["input"] != input_path or manifest["shard_size"] != config.shard_size:
+            raise ValueError("%s was written for %s with shard_size %d; remove %s to start over."
+                             % (manifest_path, manifest["input"], manifest["shard_size"], shards_dir))
+        print("Resuming: %d of %d shards done." % (len(manifest["completed"]), len(manifest["shards"])))
+    else:
+        offsets, num_lines = shard_offsets(input_path, config.shard_size)
+        shards = []
+        for i, offset in enumerate(offsets):
+            shards.append({"file": "part-%05d.txt" % i, "offset": offset,
+                           "num_lines": min(config.shard_size, num_lines - i * config.shard_size)})
+        manifest = {"input": input_path, "num_lines": num_lines, "shard_size": config.shard_size,
+                    "shards": shards, "completed": []}
+        write_json_atomic(manifest_path, manifest)
+
+    tasks = [(i, input_path, shard["offset"], shard["num_lines"], os.path.join(shards_dir, shard["file"]))
+             for i, shard in enumerate(manifest["shards"]) if i not in manifest["completed"]]
+    if tasks:
+        num_workers = min(config.num_workers, len(tasks))
+        start_time = time.time()
+        ctx = multiprocessing.get_context("spawn")
+        core_queue = ctx.Queue()
+        for cores in core_groups(num_workers):
+            core_queue.put(cores)
+        with ctx.Pool(num_workers, initializer=_init_reconstruct_worker,
+                      initargs=(config.__dict__, FLAGS.model_dir, core_queue)) as pool:
+            for shard_id in pool.imap_unordered(_reconstruct_shard, tasks):
+                manifest["completed"] = sorted(manifest["completed"] + [shard_id])
+                write_json_atomic(manifest_path, manifest)
+                print("  shard %d done, %d of %d shards, %.1fs" % (
+                    shard_id, len(manifest["completed"]), len(manifest["shards"]), time.time() - start_time))
+
+    # Merge the shards in input order.
+    with open(FLAGS.output + ".tmp", "wb") as output_f:
+        for shard in manifest["shards"]:
+            with open(os.path.join(shards_dir, shard["file"]), "rb") as shard_f:
+                shutil.copyfileobj(shard_f, output_f)
+    os.replace(FLAGS.output + ".tmp", FLAGS.output)
+    shutil.rmtree(shards_dir)
+
+
+def graph_report(config):
+    """Build the model described by config and report its size without running it.
+
+    Prints the time and graph nodes of each construction phase, the variable
+    bytes, the nodes and estimated activation memory of one step of every
+    bucket at each of batch_sizes, and the peak RSS. With forward_only off a
+    step is the bucket's update, including its gradients. The report is also
+    written as JSON to --output if given.
+    """
+    batch_sizes = config.batch_sizes or [config.batch_size]
+    start_time = time.time()
+    model = build_model(config, config.forward_only)
+    build_time = time.time() - start_time
+    graph = tf.get_default_graph()
+
+    print("Graph construction: %.2fs, %d nodes, GraphDef %.1f MB" % (
+        build_time, len(graph.get_operations()), graph.as_graph_def().ByteSize() / 2.0 ** 20))
+    for phase, seconds, num_nodes in model.build_phases:
+        print("  %-32s %8.2fs %9d nodes" % (phase, seconds, num_nodes))
+
+    trainable = tf.trainable_variables()
+    others = [v for v in tf.global_variables() if v not in trainable]
+    print("Variables: %.1f MB trainable, %.1f MB other (embeddings, optimizer slots, counters)" % (
+        variable_bytes(trainable) / 2.0 ** 20, variable_bytes(others) / 2.0 ** 20))
+
+    buckets = []
+    print("Estimated activation memory per step (upper bound):")
+    print("  %-10s %-10s %9s  %s" % ("bucket", "lengths", "nodes",
+                                    "  ".join("%10s" % ("batch %d" % b) for b in batch_sizes)))
+    for bucket_id, bucket in enumerate(config.buckets):
+        if config.forward_only:
+            fetches = [model.losses[bucket_id], model.KL_objs[bucket_id]] + model.outputs[bucket_id]
+        else:
+            fetches = [model.updates[bucket_id]]
+        ops = upstream_ops(fetches)
+        activations = activation_bytes(ops, batch_sizes)
+        print("  %-10d %-10s %9d  %s" % (bucket_id, "%dx%d" % tuple(bucket), len(ops),
+                                        "  ".join("%7.1f MB" % (a / 2.0 ** 20) for a in activations)))
+        buckets.append({"bucket": list(bucket), "nodes": len(ops),
+                        "activation_bytes": dict(zip([str(b) for b in batch_sizes], activations))})
+
+    peak_rss = peak_rss_bytes()
+    print("Peak RSS: %.1f MB" % (peak_rss / 2.0 ** 20))
+    if FLAGS.output:
+        write_json_atomic(FLAGS.output, {
+            "build_seconds": build_time, "nodes": len(graph.get_operations()),
+            "graph_def_bytes": graph.as_graph_def().ByteSize(),
+            "build_phases": [{"phase": phase, "seconds": seconds, "nodes": num_nodes}
+                             for phase, seconds, num_nodes in model.build_phases],
+            "trainable_variable_bytes": variable_bytes(trainable), "other_variable_bytes": variable_bytes(others),
+            "buckets": buckets, "peak_rss_bytes": peak_rss})
+
+
+def sweep_trials(configs, grid):
+    """Expand grid into one full set of config sections per trial.
+
+    grid maps config keys to lists of values; every combination is a trial.
+    A value goes to the train section if that has the key, else to the model
+    section.
+
+    Returns:
+      a list of (overrides, configs) pairs.
+    """
+    keys = sorted(grid)
+    trials = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        overrides = dict(zip(keys, values))
+        trial_configs = json.loads(json.dumps(configs))
+        for key, value in overrides.items():
+            section = "train" if key in trial_configs["train"] else "model"
+            trial_configs[section][key] = value
+        trials.append((overrides, trial_configs))
+    return trials
+
+
+def _run_trial(task):
+    trial_dir, entries = task
+    # Trials are spawned, so the flags main() adjusted have to be set again.
+    _set_worker_flags(model_dir=trial_dir, model_name=os.path.basename(trial_dir), do="train",
+                      new=tf.train.get_checkpoint_state(trial_dir) is None)
+    with tf.Graph().as_default():
+        train(Struct(**entries))
+    with open(os.path.join(trial_dir, "train_summary.json")) as f:
+        return trial_dir, json.load(f)
+
+
+def sweep(configs, config):
+    """Train one model per combination of the grid in the sweep section and tabulate the results.
+
+    The corpus is tokenized and the embedding matrix cached once up front, so
+    trials only read token ids. Trials train in model_dir/sweep/trial-<i>
+    (each with its full config.json) on a pool of num_workers processes,
+    each session capped at worker_threads intra-op threads, and must stop on
+    the max_steps or max_time of the sweep section. Finished trials are
+    skipped when the sweep is rerun. Dev perplexity and training speed of all
+    trials are written to model_dir/sweep/results.tsv.
+    """
+    if not config.grid:
+        raise ValueError("The sweep section needs a grid of values to try.")
+    if not config.max_steps and not config.max_time:
+        raise ValueError("Sweep trials need max_steps or max_time to stop.")
+    sweep_dir = os.path.join(os.path.abspath(FLAGS.model_dir), "sweep")
+    tasks, trial_names = [], {}
+    for i, (overrides, trial_configs) in enumerate(sweep_trials(configs, config.grid)):
+        trial_configs["train"].update(max_steps=config.max_steps, max_time=config.max_time,
+                                      intra_op_threads=config.worker_threads)
+        trial_dir = os.path.join(sweep_dir, "trial-%03d" % i)
+        trial_names[trial_dir] = overrides
+        if os.path.exists(os.path.join(trial_dir, "train_summary.json")):
+            continue
+        if not os.path.exists(trial_dir):
+            os.makedirs(trial_dir)
+        write_json_atomic(os.path.join(trial_dir, "config.json"), trial_configs)
+        entries = dict(trial_configs["model"], **trial_configs["train"])
+
+        # Tokenize and cache embeddings here once instead of in every trial.
+        trial_config = Struct(**entries)
+        _, _, vocab_path = data_utils.prepare_wmt_data(trial_config.data_dir, trial_config.vocab_size,
+                                                       bpe_merges=trial_config.bpe_merges,
+                                                       train_glob=trial_config.train_glob)
+        vocab, _ = data_utils.initialize_vocabulary(vocab_path)
+        load_embeddings(vocab, trial_config)
+        tasks.append((trial_dir, entries))
+
+    print("Running %d of %d trials." % (len(tasks), len(trial_names)))
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(config.num_workers, maxtasksperchild=1) as pool:
+        for trial_dir, summary in pool.imap_unordered(_run_trial, tasks):
+            print("  %s done: %s" % (os.path.basename(trial_dir), summary["stop_reason"]))
+
+    keys = sorted(config.grid)
+    rows = []
+    for trial_dir, overrides in sorted(trial_names.items()):
+        with open(os.path.join(trial_dir, "train_summary.json")) as f:
+            summary = json.load(f)
+        rows.append([os.path.basename(trial_dir)] + [json.dumps(overrides[key]) for key in keys] +
+                    ["%.2f" % summary["dev_perplexity"] if summary["dev_perplexity"] is not None else "-",
+                     "%.4f" % summary["best_dev_elbo"] if summary["best_dev_elbo"] is not None else "-",
+                     "%.2f" % summary["steps_per_second"], str(summary["global_step"])])
+    header = ["trial"] + keys + ["dev_perplexity", "best_dev_elbo", "steps_per_second", "steps"]
+    with open(os.path.join(sweep_dir, "results.tsv"), "w") as f:
+        for row in [header] + rows:
+            f.write("\t".join(row) + "\n")
+    widths = [max(len(row[k]) for row in [header] + rows) for k in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
 class Struct(object):
     def __init__(self, **entries):
         self.__dict__.update(entries)
@@ -503,6 +1510,74 @@ class Struct(object):
             self.__dict__.update({"anneal": False})
         if not self.__dict__.get("beam_size"):
             self.__dict__.update({"beam_size": 1})
+        if not self.__dict__.get("num_towers"):
+            self.__dict__.update({"num_towers": 1})
+        if not self.__dict__.get("tower_inter_op_threads"):
+            self.__dict__.update({"tower_inter_op_threads": 2})
+        if not self.__dict__.get("intra_op_threads"):
+            self.__dict__.update({"intra_op_threads": 0})
+        if not self.__dict__.get("quantize_projection"):
+            self.__dict__.update({"quantize_projection": False})
+        if not self.__dict__.get("num_samples"):
+            self.__dict__.update({"num_samples": 512})
+        if not self.__dict__.get("candidate_sampler"):
+            self.__dict__.update({"candidate_sampler": "log_uniform"})
+        if self.__dict__.get("unigram_distortion") is None:
+            self.__dict__.update({"unigram_distortion": 0.75})
+        if not self.__dict__.get("shortlist_size"):
+            self.__dict__.update({"shortlist_size": 0})
+        if not self.__dict__.get("bpe_merges"):
+            self.__dict__.update({"bpe_merges": 0})
+        if not self.__dict__.get("train_glob"):
+            self.__dict__.update({"train_glob": None})
+        if not self.__dict__.get("share_embeddings"):
+            self.__dict__.update({"share_embeddings": False})
+        if not self.__dict__.get("adaptive_cutoffs"):
+            self.__dict__.update({"adaptive_cutoffs": None})
+        if not self.__dict__.get("adaptive_factor"):
+            self.__dict__.update({"adaptive_factor": 4})
+        if not self.__dict__.get("cache_size"):
+            self.__dict__.update({"cache_size": 0})
+        if not self.__dict__.get("cache_ttl"):
+            self.__dict__.update({"cache_ttl": 0})
+        if not self.__dict__.get("shard_size"):
+            self.__dict__.update({"shard_size": 100000})
+        if not self.__dict__.get("num_workers"):
+            self.__dict__.update({"num_workers": 1})
+        if not self.__dict__.get("worker_threads"):
+            self.__dict__.update({"worker_threads": 2})
+        if not self.__dict__.get("interpolation"):
+            self.__dict__.update({"interpolation": "linear"})
+        if not self.__dict__.get("iw_samples"):
+            self.__dict__.update({"iw_samples": 0})
+        if not self.__dict__.get("iw_data"):
+            self.__dict__.update({"iw_data": "test.txt"})
+        if not self.__dict__.get("iw_batch_rows"):
+            self.__dict__.update({"iw_batch_rows": 4096})
+        if not self.__dict__.get("float16"):
+            self.__dict__.update({"float16": False})
+        if not self.__dict__.get("batch_sizes"):
+            self.__dict__.update({"batch_sizes": []})
+        if not self.__dict__.get("forward_only"):
+            self.__dict__.update({"forward_only": False})
+        if not self.__dict__.get("chunk_size"):
+            self.__dict__.update({"chunk_size": 1000})
+        if not self.__dict__.get("grid"):
+            self.__dict__.update({"grid": {}})
+        if not self.__dict__.get("shuffle_seed"):
+            self.__dict__.update({"shuffle_seed": 0})
+        if not self.__dict__.get("max_steps"):
+            self.__dict__.update({"max_steps": 0})
+        if not self.__dict__.get("max_time"):
+            self.__dict__.update({"max_time": 0})
+        if not self.__dict__.get("max_epochs"):
+            self.__dict__.update({"max_epochs": 0})
+        if not self.__dict__.get("patience"):
+            self.__dict__.update({"patience": 0})
+        if not self.__dict__.get("sync_replicas"):
+            self.__dict__.update({"sync_replicas": False})
+        if not self.__dict__.get("replicas_to_aggregate"):
+            self.__dict__.update({"replicas_to_aggregate": 0})
         if self.__dict__.get("beam_size") > 1:
             raise NotImplementedError("Beam search is still under implementation.")
 
@@ -515,9 +1590,10 @@ def main(_):
         configs = json.load(config_file)
 
     FLAGS.model_name = os.path.basename(os.path.normpath(FLAGS.model_dir))
-    behavior = ["train", "interpolate", "reconstruct", "sample"]
+    behavior = ["train", "interpolate", "reconstruct", "sample", "evaluate_quantization", "export",
+                "evaluate_iw", "interpolate_pairs", "encode", "sweep", "graph_report", "reconstruct_parallel"]
     if FLAGS.do not in behavior:
-        raise ValueError("argument \"do\" is not one of the following: train, interpolate, decode or sample.")
+        raise ValueError("argument \"do\" is not one of the following: %s." % ", ".join(behavior))
 
     if FLAGS.do != "train":
         FLAGS.new = False
@@ -534,15 +1610,50 @@ def main(_):
     if FLAGS.do == "reconstruct":
         with tf.Session() as sess:
             model = create_model(sess, enc_dec_config, True)
+            model.profiler = create_profiler()
+            model.cache = create_cache(enc_dec_config, reconstruct=True)
             reconstruct(sess, model, enc_dec_config)
     elif FLAGS.do == "interpolate":
         with tf.Session() as sess:
             model = create_model(sess, interp_config, True)
+            model.profiler = create_profiler()
+            model.cache = create_cache(interp_config)
             encode_interpolate(sess, model, interp_config)
+    elif FLAGS.do == "interpolate_pairs":
+        with tf.Session() as sess:
+            model = create_model(sess, config, True)
+            model.profiler = create_profiler()
+            interpolate_pairs(sess, model, config)
     elif FLAGS.do == "sample":
         with tf.Session() as sess:
             model = create_model(sess, sample_config, True)
+            model.profiler = create_profiler()
+            model.cache = create_cache(sample_config)
             n_sample(sess, model, config)
+    elif FLAGS.do == "evaluate_quantization":
+        evaluate_quantization(config)
+    elif FLAGS.do == "export":
+        export_inference(config)
+    elif FLAGS.do == "evaluate_iw":
+        evaluate_iw(config)
+    elif FLAGS.do == "encode":
+        encode_corpus(config)
+    elif FLAGS.do == "sweep":
+        sweep(configs, config)
+    elif FLAGS.do == "graph_report":
+        graph_report(config)
+    elif FLAGS.do == "reconstruct_parallel":
+        reconstruct_parallel(config)
+    elif FLAGS.do == "train" and FLAGS.job_name:
+        cluster = tf.train.ClusterSpec({"ps": FLAGS.ps_hosts.split(","),
+                                        "worker": FLAGS.worker_hosts.split(",")})
+        server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+        if FLAGS.job_name == "ps":
+            server.join()
+        elif FLAGS.job_name == "worker":
+            train(config, cluster, server)
+        else:
+            raise ValueError("argument \"job_name\" is not one of the following: ps or worker.")
     elif FLAGS.do == "train":
         train(config)
 